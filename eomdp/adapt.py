@@ -0,0 +1,73 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Online re-computation of policies from streaming training data."""
+
+import numpy as np
+from . import policy as po
+
+
+class Sketch:
+    """
+    Bounded-memory summary of recent (metric, reward) pairs, as at most nbins
+    bins of (roughly) equal weight, each with the lowest metric, total
+    weight, and total reward of its pairs. If halflife is given, weights of
+    past pairs are halved with every halflife new pairs.
+    """
+
+    def __init__(self, nbins=1024, halflife=None):
+        self.nbins, self.halflife = nbins, halflife
+        self.metrics = np.zeros(0, np.float64)
+        self.weights = np.zeros(0, np.float64)
+        self.rsums = np.zeros(0, np.float64)
+
+    def update(self, metrics, rewards):
+        """Add vectors of new metric and reward values."""
+        metrics, rewards = np.float64(metrics), np.float64(rewards)
+        if self.halflife is not None:
+            fac = 0.5**(len(metrics)/self.halflife)
+            self.weights, self.rsums = self.weights*fac, self.rsums*fac
+
+        mtr = np.concatenate((self.metrics, metrics))
+        wts = np.concatenate((self.weights, np.ones_like(metrics)))
+        rsm = np.concatenate((self.rsums, rewards))
+        if len(mtr) > self.nbins:
+            # Merge sorted pairs into bins by their starting quantile.
+            idx = np.argsort(mtr, kind='stable')
+            mtr, wts, rsm = mtr[idx], wts[idx], rsm[idx]
+            wcum = np.cumsum(wts)
+            bins = np.minimum(np.int64((wcum-wts)/wcum[-1]*self.nbins),
+                              self.nbins-1)
+            starts = np.flatnonzero(np.diff(bins, prepend=-1))
+            mtr = mtr[starts]
+            wts = np.add.reduceat(wts, starts)
+            rsm = np.add.reduceat(rsm, starts)
+        self.metrics, self.weights, self.rsums = mtr, wts, rsm
+
+    def data(self):
+        """Weighted training data (metrics, rewards, weights) for mdp."""
+        return self.metrics, self.rsums/self.weights, self.weights
+
+
+class Adapter:
+    """
+    Keeps a Sketch of recent training data for a (rate, bdepth) token
+    bucket, and re-computes the policy from it with mdp, warm-started from
+    the previous solution. Optional mdpargs are passed to mdp, with method
+    'pi' by default, since value iteration can stop early when warm-started.
+    """
+
+    def __init__(self, rate, bdepth, nbins=1024, halflife=None, **mdpargs):
+        self.rate, self.bdepth = rate, bdepth
+        self.mdpargs = {'method': 'pi', **mdpargs}
+        self.sketch = Sketch(nbins, halflife)
+        self.info = None
+
+    def update(self, metrics, rewards):
+        """Add vectors of new metric and reward values."""
+        self.sketch.update(metrics, rewards)
+
+    def solve(self):
+        """Return policy for current training data."""
+        policy, self.info = po.mdp(self.rate, self.bdepth, self.sketch.data(),
+                                   init=self.info, retinfo=True,
+                                   **self.mdpargs)
+        return policy
@@ -0,0 +1,133 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Pre-computed policies for a grid of token bucket parameters."""
+
+import os
+import numpy as np
+from . import prof
+from . import utils as ut
+from . import policy as po
+from . import simulate as sim
+
+
+@prof.timed()
+def build(path, rates, bdepths, traindata, discount=0.9999,
+          itparam=(1e4, 1e-6)):
+    """
+    Solve for policies of all (rate, bdepth) on a grid of rates and bdepths,
+    save them to directory path, and return the Atlas.
+
+    Training data is summarized once, and each bucket is solved by policy
+    iteration warm-started from the previous rate (or, at the start of each
+    row, the previous bdepth). Buckets with the same (q,p,m) are solved once.
+    """
+    rates, bdepths = np.sort(np.float64(rates)), np.sort(np.float64(bdepths))
+    metrics, rewards = np.float64(traindata[0]), np.float64(traindata[1])
+    summary = po._summarize((metrics, rewards))
+
+    qpms, policies, gains, values = [], [], [], []
+    entries = {}
+    grid = np.zeros((len(rates), len(bdepths)), np.int64)
+    rowinit = None
+    for j, bdepth in enumerate(bdepths):
+        init = rowinit
+        for i, rate in enumerate(rates):
+            qpm = tuple(int(_v) for _v in ut.getqpm(rate, bdepth))
+            assert qpm[0] < qpm[1]
+            assert qpm[2] >= qpm[1]
+            if qpm not in entries:
+                value = po._initvalue(qpm, summary, init, discount)
+                policy, value, _, _ = po._policyiter(qpm, summary, value,
+                                                     discount, itparam)
+                entries[qpm] = len(qpms)
+                qpms.append(qpm)
+                policies.append(policy)
+                values.append(value)
+                gains.append(sim.simulate(rate, bdepth, policy,
+                                          (metrics, rewards),
+                                          method='exact')[0])
+            grid[i, j] = entries[qpm]
+            init = {'value': values[grid[i, j]],
+                    'vidx': np.arange(qpm[0], qpm[2]+1)/qpm[1]}
+            if i == 0:
+                rowinit = init
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'policies.npy'), np.concatenate(policies))
+    np.save(os.path.join(path, 'data.npy'), np.stack((metrics, rewards)))
+    np.savez(os.path.join(path, 'index.npz'), rates=rates, bdepths=bdepths,
+             grid=grid, qpms=np.int64(qpms), gains=np.float64(gains),
+             offs=np.cumsum([0]+[len(_p) for _p in policies]))
+    return Atlas(path)
+
+
+def _bracket(axis, val):
+    """Indices of grid values just below and above val, and weight of upper."""
+    lo = np.searchsorted(axis, val, side='right')-1
+    if lo < 0:
+        raise ValueError("%f is below the atlas grid" % val)
+    hi = min(lo+1, len(axis)-1)
+    if val >= axis[hi]:
+        return hi, hi, 0.0
+    return lo, hi, (val-axis[lo])/(axis[hi]-axis[lo])
+
+
+class Atlas:
+    """
+    Policies saved by build in directory path. Policy vectors are stored
+    contiguously in a memory-mapped file, and indexed by their (q,p,m).
+    """
+
+    def __init__(self, path):
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.rates, self.bdepths = index['rates'], index['bdepths']
+        self.grid, self.qpms = index['grid'], index['qpms']
+        self.gains, self.offs = index['gains'], index['offs']
+        self.policies = np.load(os.path.join(path, 'policies.npy'),
+                                mmap_mode='r')
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+        self.entries = {tuple(int(_v) for _v in _q): k
+                        for k, _q in enumerate(self.qpms)}
+
+    def entry(self, k):
+        """Policy vector (a read-only view) of k-th stored bucket."""
+        return self.policies[self.offs[k]:self.offs[k+1]]
+
+    def get(self, rate, bdepth, exact=True):
+        """
+        Return policy for (rate, bdepth), and a bound on the reward lost
+        relative to the optimal policy. Buckets in the atlas are returned
+        as stored (with a bound of 0). Otherwise, thresholds at each token
+        count are interpolated bilinearly from the four neighbouring grid
+        entries, and the bound is the reward of the upper entry (which is at
+        least the optimal reward, up to solver tolerance; inf above the
+        grid) minus the exact reward of the interpolated policy on the
+        training data. If exact is False, the reward of the lower entry is
+        used instead of the exact one, which is faster but only an estimate,
+        since the interpolated policy can do worse than the lower entry.
+        """
+        qpm = ut.getqpm(rate, bdepth)
+        k = self.entries.get(qpm)
+        if k is not None:
+            return self.entry(k), 0.0
+
+        r_lo, r_hi, r_wt = _bracket(self.rates, rate)
+        b_lo, b_hi, b_wt = _bracket(self.bdepths, bdepth)
+        pidx = np.arange(qpm[1], qpm[2]+1)/qpm[1]
+        policy = np.zeros(len(pidx), np.float64)
+        for i, j, wt in [(r_lo, b_lo, (1-r_wt)*(1-b_wt)),
+                         (r_hi, b_lo, r_wt*(1-b_wt)),
+                         (r_lo, b_hi, (1-r_wt)*b_wt),
+                         (r_hi, b_hi, r_wt*b_wt)]:
+            if wt > 0:
+                _, p, m = self.qpms[self.grid[i, j]]
+                policy = policy + wt*np.interp(
+                    pidx, np.arange(p, m+1)/p, self.entry(self.grid[i, j]))
+
+        ghi = np.inf
+        if rate <= self.rates[-1] and bdepth <= self.bdepths[-1]:
+            ghi = self.gains[self.grid[r_hi, b_hi]]
+        glo = self.gains[self.grid[r_lo, b_lo]]
+        if exact:
+            glo = sim.simulate(rate, bdepth, policy, self.data,
+                               method='exact')[0]
+        return policy, max(ghi-glo, 0.0)
@@ -0,0 +1,87 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Online controller making sending decisions for live inputs."""
+
+import numpy as np
+from numba import jit
+from . import utils as ut
+
+
+@jit(nopython=True, cache=True)
+def _send(qpm, policy, mtog, nstate, cam, value):
+    """Decide for one input at camera cam, and update its state in place."""
+    if mtog.shape[1] > 0:
+        value = np.interp(value, mtog[0], mtog[1])
+    ncur = nstate[cam]
+    send = ncur >= qpm[1] and value >= policy[ncur-qpm[1]]
+    if send:
+        ncur = ncur - qpm[1]
+    nstate[cam] = min(ncur + qpm[0], qpm[2])
+    return send
+
+
+@jit(nopython=True, cache=True)
+def _step(qpm, policy, mtog, nstate, values, sends):
+    """Decide for (T, ncam) inputs in time order, writing to sends."""
+    for t in range(values.shape[0]):
+        for cam in range(values.shape[1]):
+            sends[t, cam] = _send(qpm, policy, mtog, nstate, cam,
+                                  values[t, cam])
+
+
+class Controller:
+    """
+    Decides whether to send inputs from ncam cameras, each with its own
+    (rate, bdepth) token bucket and the same policy, starting with full
+    buckets. Decisions are identical to those made by simulate. If mtog (as
+    returned by fitmetric) is given, inputs are entropies and are mapped to
+    metrics with it, and are otherwise metrics.
+    """
+
+    def __init__(self, rate, bdepth, policy, ncam=1, mtog=None):
+        self.qpm = np.int64(ut.getqpm(rate, bdepth))
+        self.policy = np.float64(policy)
+        assert len(self.policy) == self.qpm[2]-self.qpm[1]+1
+        self.mtog = np.zeros((2, 0)) if mtog is None else \
+            np.float64(np.stack(mtog))
+        self.nstate = np.full(ncam, self.qpm[2], np.int64)
+        self.sends = np.zeros(ncam, np.bool_)
+
+    def reconfigure(self, rate, bdepth, policy):
+        """
+        Switch all cameras to a (rate, bdepth) bucket and its policy,
+        keeping (up to the new depth) the number of tokens in each bucket.
+        """
+        qpm = np.int64(ut.getqpm(rate, bdepth))
+        assert len(policy) == qpm[2]-qpm[1]+1
+        self.nstate[:] = np.minimum(self.nstate*qpm[1]//self.qpm[1], qpm[2])
+        self.qpm, self.policy = qpm, np.float64(policy)
+
+    def reset(self):
+        """Fill all buckets."""
+        self.nstate[:] = self.qpm[2]
+
+    def tokens(self):
+        """Number of tokens in bucket of each camera."""
+        return self.nstate/self.qpm[1]
+
+    def send(self, value, cam=0):
+        """Return whether to send a single input at camera cam."""
+        return _send(self.qpm, self.policy, self.mtog, self.nstate, cam,
+                     value)
+
+    def step(self, values, out=None):
+        """
+        Decide for one input from each camera, given as a (ncam,) array, or
+        for a sequence of them, as a (T, ncam) array. Returns a boolean
+        array of the same shape with decisions (written to out if given, or
+        for a (ncam,) input to an array owned by the controller and re-used
+        by the next call), and the (ncam,) array of updated token states in
+        units of 1/p tokens (also owned by the controller).
+        """
+        if out is None:
+            out = self.sends if values.ndim == 1 else \
+                np.zeros(values.shape, np.bool_)
+        ncam = len(self.nstate)
+        _step(self.qpm, self.policy, self.mtog, self.nstate,
+              values.reshape(-1, ncam), out.reshape(-1, ncam))
+        return out, self.nstate
@@ -0,0 +1,67 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Functions for memory-mapped dataset ingestion and per-fold statistics."""
+
+import os
+import numpy as np
+from . import prof
+from . import utils as ut
+
+
+class _Rows:
+    """Row subset of a (memory-mapped) array, read only when sliced."""
+
+    def __init__(self, array, rows):
+        self.array, self.rows = array, rows
+        self.shape = (len(rows),) + array.shape[1:]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, sl):
+        return self.array[self.rows[sl]]
+
+
+@prof.timed()
+def convert(npzpath, outdir):
+    """Write each array in an npz file to an uncompressed npy in outdir."""
+    os.makedirs(outdir, exist_ok=True)
+    with np.load(npzpath) as npz:
+        for key in npz.files:
+            np.save(os.path.join(outdir, key + '.npy'), npz[key])
+
+
+def load(outdir):
+    """Return dictionary of memory-mapped arrays written by convert."""
+    return {fname[:-4]: np.load(os.path.join(outdir, fname), mmap_mode='r')
+            for fname in os.listdir(outdir) if fname.endswith('.npy')}
+
+
+@prof.timed()
+def foldsplit(dset, fold, cost, memlimit=2**28):
+    """
+    Calibrate on training folds, and return dictionary of entropies and
+    costs for train (!= fold) and test (== fold) sets.
+
+    Logits are read from dset['wlogit'] in chunks of at most memlimit bytes,
+    without copying the full array for either split.
+    """
+    npz = {}
+    split = np.asarray(dset['split'])
+    idx_tr = np.flatnonzero(split != fold)
+    idx_ts = np.flatnonzero(split == fold)
+
+    lgt_tr = _Rows(dset['wlogit'], idx_tr)
+    lgt_ts = _Rows(dset['wlogit'], idx_ts)
+    tinv = ut.calib(lgt_tr, np.asarray(dset['gt'])[idx_tr],
+                    memlimit=memlimit)
+    npz['tinv'] = tinv
+
+    npz['entr_tr'] = ut.entropy(lgt_tr, tinv, memlimit)
+    npz['entr_ts'] = ut.entropy(lgt_ts, tinv, memlimit)
+
+    wrank, srank = np.asarray(dset['wrank']), np.asarray(dset['srank'])
+    npz['wcost_tr'], npz['scost_tr'] = ut.cost(wrank[idx_tr], srank[idx_tr],
+                                               cost)
+    npz['wcost_ts'], npz['scost_ts'] = ut.cost(wrank[idx_ts], srank[idx_ts],
+                                               cost)
+    return npz
@@ -0,0 +1,367 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Compiled simulation kernels, cached on disk, with explicit signatures."""
+
+import multiprocessing as mp
+import numpy as np
+from numba import jit, prange, types
+
+
+@jit(nopython=True, cache=True)
+def _rand(state):
+    """Advance splitmix64 state, and return (new state, random uint64)."""
+    state = state + np.uint64(0x9E3779B97F4A7C15)
+    rnd = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    rnd = (rnd ^ (rnd >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return state, rnd ^ (rnd >> np.uint64(31))
+
+
+@jit(nopython=True, cache=True)
+def _randidx(state, nidx):
+    """Advance state, and return a random integer in [0, nidx)."""
+    state, rnd = _rand(state)
+    return state, np.int64(((rnd >> np.uint64(32))*np.uint64(nidx))
+                           >> np.uint64(32))
+
+
+@jit(nopython=True, cache=True)
+def _rngstates(seed, nstream):
+    """Independent RNG states for each of nstream streams."""
+    states = np.zeros(nstream, np.uint64)
+    for i in range(nstream):
+        _, states[i] = _rand(np.uint64(seed) * np.uint64(0x100000001B3) +
+                             np.uint64(i))
+    return states
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _simulate(qpm, policy, dset_mr, nsteps, nstate, rngs, gains, hists):
+    """
+    Compiled implementation of simulate.
+
+    Runs nsteps steps on each stream, in parallel across blocks of streams,
+    updating bucket states nstate, RNG states rngs, and per-stream gains in
+    place. Counts are added to per-block histograms hists = (send_m, send_s,
+    occup_s), each with a leading dimension for the block.
+    """
+
+    assert qpm[0] < qpm[1]
+    assert qpm[2] >= qpm[1]
+    assert len(policy) == qpm[2]-qpm[1]+1
+
+    metrics, rewards = dset_mr
+    send_m, send_s, occup_s = hists
+    nblk = send_m.shape[0]
+    for blk in prange(nblk):
+        for j in range(blk, len(nstate), nblk):
+            ncur, state, gain = nstate[j], rngs[j], 0.
+            for _ in range(nsteps):
+                state, tidx = _randidx(state, len(metrics))
+                occup_s[blk, ncur-qpm[0]] += 1
+                send_m[blk, tidx, 1] += 1
+                if ncur >= qpm[1] and metrics[tidx] >= policy[ncur-qpm[1]]:
+                    send_m[blk, tidx, 0] += 1
+                    send_s[blk, ncur-qpm[1]] += 1
+                    gain = gain + rewards[tidx]
+                    ncur = ncur - qpm[1]
+                ncur = min(ncur + qpm[0], qpm[2])
+            nstate[j], rngs[j], gains[j] = ncur, state, gains[j] + gain
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _mcsimulate(qpm_i, qpm_g, ncam, policy, dset_mr, nsteps,
+                nistate, ngstate, rngs, gains, occup_s):
+    """
+    Compiled implementation of mcsimulate.
+
+    Like _simulate, runs nsteps steps on each stream (of ncam devices and a
+    switch) in parallel across blocks of streams, updating device and switch
+    bucket states, RNG states, and gains in place, and adding switch
+    occupancy counts to per-block histogram occup_s.
+    """
+
+    assert qpm_i[0] < qpm_i[1]
+    assert qpm_i[2] >= qpm_i[1]
+    assert len(policy) == qpm_i[2]-qpm_i[1]+1
+    assert qpm_g[0] < qpm_g[1]
+    assert qpm_g[2] >= qpm_g[1]
+
+    metrics, rewards = dset_mr
+    nblk = occup_s.shape[0]
+    for blk in prange(nblk):
+        for j in range(blk, len(ngstate), nblk):
+            ngcur, state, gain = ngstate[j], rngs[j], 0.
+            for _ in range(nsteps):
+                for k in range(j*ncam, (j+1)*ncam):
+                    state, tidx = _randidx(state, len(metrics))
+                    nicur = nistate[k]
+                    ifsend = nicur >= qpm_i[1] and \
+                        metrics[tidx] >= policy[nicur-qpm_i[1]]
+                    if ifsend:
+                        nicur = nicur - qpm_i[1]
+                    nistate[k] = min(nicur + qpm_i[0], qpm_i[2])
+
+                    occup_s[blk, ngcur-qpm_g[0]] += 1
+                    if ifsend and ngcur >= qpm_g[1]:
+                        gain = gain + rewards[tidx]
+                        ngcur = ngcur - qpm_g[1]
+                    ngcur = min(ngcur + qpm_g[0], qpm_g[2])
+            ngstate[j], rngs[j], gains[j] = ngcur, state, gains[j] + gain
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _mcsimulate_many(qpms_i, qpm_g, ncam, policies, dset_mr, nsteps,
+                     nistate, ngstate, rngs, gains, occup_s, nblk):
+    """
+    Compiled implementation of mcsimulate_many.
+
+    Candidates are split into nblk blocks that run in parallel. Within a block,
+    each input drawn from a stream is shared by all candidates. Since every
+    block starts from the same RNG states rngs, all candidates see the same
+    inputs. Bucket states (nistate of shape (K, streams*ncam), ngstate of
+    shape (K, streams)), per-stream gains (K, streams), and switch occupancy
+    counts occup_s (K, M_g-Q_g+1) are updated in place, and the final RNG
+    states are written back to rngs.
+    """
+
+    assert qpm_g[0] < qpm_g[1]
+    assert qpm_g[2] >= qpm_g[1]
+    for k in range(len(qpms_i)):
+        assert qpms_i[k, 0] < qpms_i[k, 1]
+        assert qpms_i[k, 2] >= qpms_i[k, 1]
+
+    metrics, rewards = dset_mr
+    ncand = len(qpms_i)
+    rngs_out = rngs.copy()
+    for blk in prange(nblk):
+        kst, ken = blk*ncand//nblk, (blk+1)*ncand//nblk
+        for j in range(len(rngs)):
+            state = rngs[j]
+            for _ in range(nsteps):
+                for dev in range(j*ncam, (j+1)*ncam):
+                    state, tidx = _randidx(state, len(metrics))
+                    mcur, rcur = metrics[tidx], rewards[tidx]
+                    for k in range(kst, ken):
+                        q_i, p_i, m_i = qpms_i[k, 0], qpms_i[k, 1], \
+                            qpms_i[k, 2]
+                        nicur, ngcur = nistate[k, dev], ngstate[k, j]
+                        ifsend = nicur >= p_i and \
+                            mcur >= policies[k, nicur-p_i]
+                        if ifsend:
+                            nicur = nicur - p_i
+                        nistate[k, dev] = min(nicur + q_i, m_i)
+
+                        occup_s[k, ngcur-qpm_g[0]] += 1
+                        if ifsend and ngcur >= qpm_g[1]:
+                            gains[k, j] = gains[k, j] + rcur
+                            ngcur = ngcur - qpm_g[1]
+                        ngstate[k, j] = min(ngcur + qpm_g[0], qpm_g[2])
+            if blk == 0:
+                rngs_out[j] = state
+    rngs[:] = rngs_out
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _fleetsimulate(qpms_i, devcls, qpm_g, policies, doffs, dset_mr, nsteps,
+                   tstart, arbiter, nistate, ngstate, order, rngs, gains,
+                   occup_s):
+    """
+    Compiled implementation of fleetsimulate.
+
+    Devices belong to classes devcls, and each class k has its own bucket
+    qpms_i[k], policy policies[k] (padded with inf), and inputs sampled from
+    dset_mr[doffs[k, 0]:doffs[k, 1]]. Devices reach the switch in each step
+    in order (arbiter=0), rotated by one every step (1, with tstart steps
+    already run), or in random order (2, shuffling order of each stream).
+    Otherwise like _mcsimulate, with gains (streams, K) per class.
+    """
+
+    assert qpm_g[0] < qpm_g[1]
+    assert qpm_g[2] >= qpm_g[1]
+    for k in range(len(qpms_i)):
+        assert qpms_i[k, 0] < qpms_i[k, 1]
+        assert qpms_i[k, 2] >= qpms_i[k, 1]
+        assert doffs[k, 0] < doffs[k, 1]
+
+    metrics, rewards = dset_mr
+    ndev, nblk = len(devcls), occup_s.shape[0]
+    for blk in prange(nblk):
+        for j in range(blk, len(ngstate), nblk):
+            ngcur, state = ngstate[j], rngs[j]
+            for stp in range(nsteps):
+                if arbiter == 2:
+                    for i in range(ndev-1, 0, -1):
+                        state, swp = _randidx(state, i+1)
+                        order[j, i], order[j, swp] = order[j, swp], \
+                            order[j, i]
+                for i in range(ndev):
+                    dev = i
+                    if arbiter == 1:
+                        dev = (i + tstart + stp) % ndev
+                    elif arbiter == 2:
+                        dev = order[j, i]
+                    k = devcls[dev]
+                    state, tidx = _randidx(state, doffs[k, 1]-doffs[k, 0])
+                    tidx = tidx + doffs[k, 0]
+                    nicur = nistate[j, dev]
+                    ifsend = nicur >= qpms_i[k, 1] and \
+                        metrics[tidx] >= policies[k, nicur-qpms_i[k, 1]]
+                    if ifsend:
+                        nicur = nicur - qpms_i[k, 1]
+                    nistate[j, dev] = min(nicur + qpms_i[k, 0], qpms_i[k, 2])
+
+                    occup_s[blk, ngcur-qpm_g[0]] += 1
+                    if ifsend and ngcur >= qpm_g[1]:
+                        gains[j, k] = gains[j, k] + rewards[tidx]
+                        ngcur = ngcur - qpm_g[1]
+                    ngcur = min(ngcur + qpm_g[0], qpm_g[2])
+            ngstate[j], rngs[j] = ngcur, state
+
+
+@jit(nopython=True, cache=True)
+def _replay(qpm, policy, metrics, rewards, cams, nstate, gains, counts,
+            send_s, occup_s):
+    """
+    Compiled implementation of trace.replay for one chunk of a trace.
+
+    Frames are processed in order, each with the bucket state in nstate of
+    its camera cams[t] (or camera 0 if cams is empty). Bucket states,
+    per-camera gains and frame counts, and histograms send_s and occup_s
+    are updated in place, to be carried over to the next chunk.
+    """
+
+    assert qpm[0] < qpm[1]
+    assert qpm[2] >= qpm[1]
+    assert len(policy) == qpm[2]-qpm[1]+1
+
+    hascam = len(cams) > 0
+    for t in range(len(metrics)):
+        cam = cams[t] if hascam else 0
+        assert cam >= 0 and cam < len(nstate)
+        ncur = nstate[cam]
+        occup_s[ncur-qpm[0]] += 1
+        counts[cam] += 1
+        if ncur >= qpm[1] and metrics[t] >= policy[ncur-qpm[1]]:
+            send_s[ncur-qpm[1]] += 1
+            gains[cam] = gains[cam] + rewards[t]
+            ncur = ncur - qpm[1]
+        nstate[cam] = min(ncur + qpm[0], qpm[2])
+
+
+@jit(nopython=True, cache=True)
+def _gth(band, nlo):
+    """
+    Stationary distribution of a Markov chain with banded transition matrix
+    band[i, j-i+nlo] = P[i,j], by GTH state reduction from the last state
+    down, which keeps the band. If no state below some k can be reached from
+    k once higher states are removed, states below k are transient and get
+    zero probability.
+    """
+    band, nsz = band.copy(), band.shape[0]
+    nup = band.shape[1]-nlo-1
+    outsum = np.zeros(nsz, np.float64)
+    low = 0
+    for k in range(nsz-1, 0, -1):
+        for j in range(max(0, k-nlo), k):
+            outsum[k] = outsum[k] + band[k, j-k+nlo]
+        if outsum[k] <= 0.:
+            low = k
+            break
+        for i in range(max(0, k-nup), k):
+            fac = band[i, k-i+nlo]/outsum[k]
+            if fac == 0.:
+                continue
+            for j in range(max(0, k-nlo), k):
+                band[i, j-i+nlo] = band[i, j-i+nlo] + fac*band[k, j-k+nlo]
+
+    dist = np.zeros(nsz, np.float64)
+    dist[low] = 1.
+    for k in range(low+1, nsz):
+        for i in range(max(low, k-nup), k):
+            dist[k] = dist[k] + dist[i]*band[i, k-i+nlo]
+        dist[k] = dist[k]/outsum[k]
+    return dist/np.sum(dist)
+
+
+def counttype(total):
+    """Integer type for states and counts, int32 if total fits."""
+    return np.int32 if total < 2**31 else np.int64
+
+
+def frozen(arr, dtype):
+    """Read-only C-contiguous view (or copy if needed) of arr as dtype."""
+    arr = np.ascontiguousarray(arr, dtype).view()
+    arr.flags.writeable = False
+    return arr
+
+
+def data(dset_mr):
+    """Frozen (metrics, rewards), kept float32 if both are float32."""
+    dtype = np.float32 if all(np.asarray(_d).dtype == np.float32
+                              for _d in dset_mr) else np.float64
+    return tuple(frozen(_d, dtype) for _d in dset_mr)
+
+
+def _arr(dtype, ndim, readonly=False):
+    """Type of C-contiguous array (read-only for inputs)."""
+    return types.Array(dtype, ndim, 'C', readonly=readonly)
+
+
+def signatures():
+    """Dictionary of lists of argument types of each kernel."""
+    i64, u64, f64 = types.int64, types.uint64, types.float64
+    sigs = {_rngstates: [(i64, i64)],
+            _simulate: [], _mcsimulate: [], _mcsimulate_many: [],
+            _fleetsimulate: [], _replay: [],
+            _gth: [(_arr(f64, 2), i64)]}
+
+    # Variants for float32 or float64 data, and int32 or int64 counts.
+    for dtype in [types.float32, f64]:
+        dset = types.UniTuple(_arr(dtype, 1, True), 2)
+        for itype in [types.int32, i64]:
+            sigs[_simulate].append(
+                (_arr(i64, 1, True), _arr(f64, 1, True), dset, i64,
+                 _arr(itype, 1), _arr(u64, 1), _arr(f64, 1),
+                 types.Tuple((_arr(itype, 3), _arr(itype, 2),
+                              _arr(itype, 2)))))
+            sigs[_mcsimulate].append(
+                (_arr(i64, 1, True), _arr(i64, 1, True), i64,
+                 _arr(f64, 1, True), dset, i64, _arr(itype, 1),
+                 _arr(itype, 1), _arr(u64, 1), _arr(f64, 1),
+                 _arr(itype, 2)))
+            sigs[_mcsimulate_many].append(
+                (_arr(i64, 2, True), _arr(i64, 1, True), i64,
+                 _arr(f64, 2, True), dset, i64, _arr(itype, 2),
+                 _arr(itype, 2), _arr(u64, 1), _arr(f64, 2),
+                 _arr(itype, 2), i64))
+            sigs[_fleetsimulate].append(
+                (_arr(i64, 2, True), _arr(i64, 1, True), _arr(i64, 1, True),
+                 _arr(f64, 2, True), _arr(i64, 2, True), dset, i64, i64,
+                 i64, _arr(itype, 2), _arr(itype, 1), _arr(i64, 2),
+                 _arr(u64, 1), _arr(f64, 2), _arr(itype, 2)))
+
+        # Camera ids in traces are int32 or int64, and counts always int64.
+        for ctype in [types.int32, i64]:
+            sigs[_replay].append(
+                (_arr(i64, 1, True), _arr(f64, 1, True), _arr(dtype, 1, True),
+                 _arr(dtype, 1, True), _arr(ctype, 1, True), _arr(i64, 1),
+                 _arr(f64, 1), _arr(i64, 1), _arr(i64, 1), _arr(i64, 1)))
+    return sigs
+
+
+def _compile():
+    """Compile all kernels for all signatures."""
+    for kern, sigs in signatures().items():
+        for sig in sigs:
+            kern.compile(sig)
+
+
+def precompile():
+    """
+    Compile all kernels for all signatures into the disk cache, from which
+    they are loaded on first call by any process. Compilation runs in a
+    separate process, since compiling parallel kernels starts the numba
+    threading layer, after which it is unsafe to fork a pool of workers.
+    """
+    proc = mp.get_context('spawn').Process(target=_compile)
+    proc.start()
+    proc.join()
@@ -1,90 +1,420 @@
 # - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
 """Functions for determining optimal offloading policy."""
 
+from time import perf_counter
 import numpy as np
+from numba import jit
+from . import prof
 from . import utils as ut
 
 _HFITRANGE = np.power(2.0, np.arange(-8, -3.5, 0.5))
+_KTRUNC = 6.0  # Truncate RBF kernel beyond this many bandwidths
+_KFINE = 4  # Bin entropies on a grid this many times finer than xbins
 
 
-def fitmetric(etrain, rtrue, _hrange=_HFITRANGE):
+def _rbfpred(_h, ent, rew, xbins):
+    """Exact RBF regression of ent -> rew with bandwidth _h at xbins."""
+    outr = np.zeros_like(xbins)
+    for idx in range(0, len(xbins), 100):
+        _wt = -(xbins[idx:(idx+100), np.newaxis] - ent)**2
+        _wt = _wt - np.max(_wt, 1, keepdims=True)
+        _wt = np.exp(_wt/(_h*_h))
+        _wt = _wt / np.sum(_wt, 1, keepdims=True)
+        outr[idx:(idx+100)] = np.sum(_wt*rew, 1)
+    return outr
+
+
+def _nearpred(_h, ent, rew, xbins):
+    """Exact RBF regression at xbins using samples near the closest one."""
+    idx = np.argsort(ent)
+    ent, rew = ent[idx], rew[idx]
+
+    # Samples further than rad have weight < exp(-_KTRUNC^2) relative to the
+    # closest sample at distance dmin.
+    pos = np.searchsorted(ent, xbins)
+    dmin = np.minimum(np.abs(xbins-ent[np.maximum(pos-1, 0)]),
+                      np.abs(ent[np.minimum(pos, len(ent)-1)]-xbins))
+    rad = np.sqrt(dmin**2 + (_KTRUNC*_h)**2)
+    lidx = np.searchsorted(ent, xbins-rad, side='left')
+    ridx = np.searchsorted(ent, xbins+rad, side='right')
+
+    outr = np.zeros_like(xbins)
+    for i, _x in enumerate(xbins):
+        _wt = np.exp((dmin[i]**2 - (_x-ent[lidx[i]:ridx[i]])**2)/(_h*_h))
+        outr[i] = np.sum(_wt*rew[lidx[i]:ridx[i]]) / np.sum(_wt)
+    return outr
+
+
+def _binsums(ent, rew, xbins):
+    """Linearly bin counts and reward sums of (ent, rew) onto xbins."""
+    pos = (ent-xbins[0])/(xbins[1]-xbins[0])
+    lidx = np.clip(np.int64(np.floor(pos)), 0, len(xbins)-2)
+    wt = np.clip(pos-lidx, 0., 1.)
+
+    def bsum(vals):
+        return np.bincount(lidx, vals*(1-wt), len(xbins)) + \
+            np.bincount(lidx+1, vals*wt, len(xbins))
+    return bsum(np.ones_like(wt)), bsum(rew)
+
+
+def _smooth(_h, bsums, ent, rew, xbins):
+    """Binned RBF regression of ent -> rew with bandwidth _h at xbins."""
+
+    # Sums are binned on a grid _KFINE times finer than xbins.
+    nfine = len(bsums[0])
+    dxf = (xbins[-1]-xbins[0])/(nfine-1)
+    hwid = min(nfine-1, int(np.ceil(_KTRUNC*_h/dxf)))
+    kern = np.exp(-(np.arange(-hwid, hwid+1)*dxf/_h)**2)
+
+    nfft = 1 << int(np.ceil(np.log2(nfine+2*hwid)))
+    kern = np.fft.rfft(kern, nfft)
+    den = np.fft.irfft(np.fft.rfft(bsums[0], nfft)*kern, nfft)
+    num = np.fft.irfft(np.fft.rfft(bsums[1], nfft)*kern, nfft)
+    den = den[hwid:(hwid+nfine):_KFINE]
+    num = num[hwid:(hwid+nfine):_KFINE]
+
+    # Bins with less than one sample's worth of weight fall back to exact
+    # regression, which then uses the nearest samples.
+    outr = num / np.maximum(den, 1e-300)
+    far = den < 1.0
+    if np.any(far):
+        outr[far] = _nearpred(_h, ent, rew, xbins[far])
+    return outr
+
+
+@prof.timed()
+def fitmetric(etrain, rtrue, _hrange=_HFITRANGE, _exact=False):
     """
     Fit mapping from entropy to offloading metric.
 
     Returns a tuple f = (xbins, ybins). Call with np.interp(theta, *f)
     to map vector theta of entropy values to metric.
+
+    Regression is done by FFT convolution on linearly binned entropies, with
+    a kernel truncated at _KTRUNC bandwidths. Binned sums of the fitting half
+    are shared across all bandwidths. Predictions match exact RBF regression
+    (_exact=True) to within about 5e-4 of the reward range.
     """
     xbins = np.linspace(np.min(etrain), np.max(etrain), 1000)
+    xfine = np.linspace(xbins[0], xbins[-1], _KFINE*(len(xbins)-1)+1)
 
     # Fit ent -> rew with RBF bandwidth _h, and predict
     # on values in xbins.
-    def pred(_h, ent, rew):
-        outr = np.zeros_like(xbins)
-        for idx in range(0, len(xbins), 100):
-            _wt = -(xbins[idx:(idx+100), np.newaxis] - ent)**2
-            _wt = _wt - np.max(_wt, 1, keepdims=True)
-            _wt = np.exp(_wt/(_h*_h))
-            _wt = _wt / np.sum(_wt, 1, keepdims=True)
-            outr[idx:(idx+100)] = np.sum(_wt*rew, 1)
-        return outr
+    def pred(_h, ent, rew, bsums):
+        if _exact:
+            return _rbfpred(_h, ent, rew, xbins)
+        return _smooth(_h, bsums, ent, rew, xbins)
 
     # Fit on (et0,rt0) and check on (et1,rt1)
     # to find best bandwidth.
     et0, rt0 = etrain[::2], rtrue[::2]
     et1, rt1 = etrain[1::2], rtrue[1::2]
+    bsums = _binsums(et0, rt0, xfine)
 
     hrange = _hrange*(xbins[-1]-xbins[0])
     hbest, fbest = None, np.inf
     for _h in hrange:
-        rpred1 = np.interp(et1, xbins, pred(_h, et0, rt0))
+        rpred1 = np.interp(et1, xbins, pred(_h, et0, rt0, bsums))
         cost = np.mean(np.abs(rpred1-rt1)**2)
         if cost < fbest:
             hbest, fbest = _h, cost
 
+    prof.note(iters=len(hrange))
+
     # Final result is with best h fit to all data.
-    ybins = pred(hbest, etrain, rtrue)
+    ybins = pred(hbest, etrain, rtrue, _binsums(etrain, rtrue, xfine))
 
     return (xbins, ybins)
 
 
-def mdp(rate, bdepth, traindata, discount=0.9999, itparam=(1e4, 1e-6)):
-    """Find optimal policy thresholds given token bucket parameters."""
+def _uhull(ftheta, gtheta):
+    """Indices of vertices on upper convex hull of (ftheta, gtheta)."""
+    hull = np.zeros(len(ftheta), np.int64)
+    nh = 0
+    for k in range(len(ftheta)):
+        while nh > 1:
+            i, j = hull[nh-2], hull[nh-1]
+            if (gtheta[j]-gtheta[i])*(ftheta[k]-ftheta[i]) > \
+               (gtheta[k]-gtheta[i])*(ftheta[j]-ftheta[i]):
+                break
+            nh = nh-1
+        hull[nh] = k
+        nh = nh+1
+    return hull[:nh]
+
 
-    qpm = ut.getqpm(rate, bdepth)
-    assert qpm[0] < qpm[1]
-    assert qpm[2] >= qpm[1]
+def _backup(hull, slopes, ftheta, gtheta, vsend, vnosend, discount):
+    """Bellman backup for states that can send, using the hull of (F,G)."""
+
+    # Score g + discount*(f*vsend + (1-f)*vnosend) is linear in (f,g), so
+    # optimum is the first hull vertex after which (negated) edge slopes
+    # are no longer below discount*(vsend-vnosend).
+    cslope = discount*(vsend-vnosend)
+    kidx = hull[np.searchsorted(slopes, cslope, side='left')]
+    f, g = ftheta[kidx], gtheta[kidx]
+    return g + discount*(f*vsend + (1-f)*vnosend), kidx
 
-    # Sort metrics and compute F(theta) and G(theta)
-    def summarize():
-        metrics, rewards = traindata
-        idx = np.argsort(-metrics)
-        metrics, rewards = np.float64(metrics[idx]), np.float64(rewards[idx])
+
+def _summarize(traindata):
+    """
+    Sort metrics and compute F(theta), G(theta), and the (F,G) hull, with
+    samples weighted by traindata[2] if present.
+    """
+    metrics, rewards = traindata[:2]
+    idx = np.argsort(-metrics)
+    metrics, rewards = np.float64(metrics[idx]), np.float64(rewards[idx])
+    if len(traindata) > 2:
+        weights = np.float64(traindata[2])[idx]
+        wsum = np.cumsum(weights)
+        gtheta = np.cumsum(rewards*weights) / wsum[-1]
+        ftheta = wsum / wsum[-1]
+    else:
         gtheta = np.cumsum(rewards) / len(rewards)
         ftheta = np.float64(np.arange(1, len(rewards)+1)) / len(rewards)
-        fgt = (np.reshape(ftheta, (-1, 1)), np.reshape(gtheta, (-1, 1)))
-        return metrics, fgt
 
-    metrics, fgt = summarize()
+    # Only points on the upper convex hull of the (F,G) curve can
+    # maximize the Bellman score.
+    hull = _uhull(ftheta, gtheta)
+    slopes = -np.diff(gtheta[hull])/np.diff(ftheta[hull])
+    return metrics, (ftheta, gtheta), (hull, slopes)
+
+
+def _transitions(qpms):
+    """Stack value vectors of many buckets, and index next states."""
+    nsend, nnosend, offs, poffs = [], [], [0], [0]
+    for q, p, m in qpms:
+        sidx = np.arange(m-q+1)
+        nnosend.append(offs[-1] + np.minimum(sidx+q, m-q))
+        nsend.append(offs[-1] + sidx[(p-q):] + q - p)
+        offs.append(offs[-1] + m-q+1)
+        poffs.append(poffs[-1] + m-p+1)
+    return np.concatenate(nsend), np.concatenate(nnosend), offs, poffs
+
+
+def _solve(qpms, summary, discount, itparam, vinit=None):
+    """Run value iterations for a list of token buckets together."""
+
+    metrics, fgt, hsl = summary
     thresh = np.amax(np.abs(metrics))*itparam[1]
 
-    # Do value iterations
-    value, policy = np.zeros((qpm[2]-qpm[0]+1), np.float64), None
+    # Value vectors of all buckets are stacked into a single vector, with
+    # next states found by indexing. Buckets are dropped from the active set
+    # as they converge: when the policy is unchanged between sweeps, and if
+    # warm-started (when the policy can stall before values converge), when
+    # the span of the change in values is also below threshold.
+    nsend, nnosend, offs, poffs = _transitions(qpms)
+    cansend = np.ones(offs[-1], np.bool_)
+    for i, (q, p, _) in enumerate(qpms):
+        cansend[offs[i]:(offs[i]+p-q)] = False
+
+    value = np.zeros(offs[-1], np.float64) if vinit is None \
+        else np.array(vinit, np.float64)
+    policy = np.zeros(poffs[-1], np.float64)
+    active, sidx = list(range(len(qpms))), None
     for i in range(int(itparam[0])):
-        vprev, pprev = value.copy(), policy
-        vprev = np.concatenate((vprev, [vprev[-1]]*qpm[0]))
+        if sidx is None:
+            sidx = np.concatenate([np.arange(offs[j], offs[j+1])
+                                   for j in active])
+            pidx = np.concatenate([np.arange(poffs[j], poffs[j+1])
+                                   for j in active])
+            pstart = np.cumsum([0] + [poffs[j+1]-poffs[j]
+                                      for j in active[:-1]])
+            sstart = np.cumsum([0] + [offs[j+1]-offs[j]
+                                      for j in active[:-1]])
+            csidx = cansend[sidx]
+            nssidx, nnsidx = nsend[pidx], nnosend[sidx]
 
         # If n < P/P, can't send
-        value[:(qpm[1]-qpm[0])] = discount*vprev[qpm[0]:qpm[1]]
+        vnew = discount*value[nnsidx]
 
         # If n >= P/P:
-        vnosend = vprev[qpm[1]:(qpm[2]+1)]
-        vsend = vprev[:(qpm[2]-qpm[1]+1)]
-        score = fgt[1] + discount*(fgt[0]*vsend + (1-fgt[0])*vnosend)
-        value[(qpm[1]-qpm[0]):] = np.amax(score, 0)
-        policy = metrics[np.argmax(score, 0)]
+        vnew[csidx], kidx = _backup(*hsl, *fgt, value[nssidx],
+                                    value[nnsidx[csidx]], discount)
+        vdiff, value[sidx] = vnew-value[sidx], vnew
 
+        pprev, policy[pidx] = policy[pidx], metrics[kidx]
         if i > 0:
-            if np.max(np.abs(policy-pprev)) < thresh:
+            pdiff = np.maximum.reduceat(np.abs(policy[pidx]-pprev), pstart)
+            if vinit is not None:
+                pdiff = np.maximum(pdiff, np.maximum.reduceat(vdiff, sstart)
+                                   - np.minimum.reduceat(vdiff, sstart))
+            if np.any(pdiff < thresh):
+                active = [j for j, _d in zip(active, pdiff) if _d >= thresh]
+                if not active:
+                    break
+                sidx = None
+
+    return [policy[poffs[j]:poffs[j+1]] for j in range(len(qpms))], \
+        [value[offs[j]:offs[j+1]] for j in range(len(qpms))], i+1
+
+
+def _bellman(qpm, summary, value, discount):
+    """Single Bellman backup for one bucket: returns new value and argmax."""
+    _, fgt, hsl = summary
+    q, p, m = qpm
+    vext = np.concatenate((value, [value[-1]]*q))
+    tvalue = discount*vext[q:(m+1)]
+    tvalue[(p-q):], kidx = _backup(*hsl, *fgt, vext[:(m-p+1)],
+                                   vext[p:(m+1)], discount)
+    return tvalue, kidx
+
+
+@jit(nopython=True, cache=True)
+def _bandsolve(band, nlo, rhs):
+    """Solve banded system with band[i, j-i+nlo] = A[i,j], no pivoting."""
+    band, rhs = band.copy(), rhs.copy()
+    nsz, nup = len(rhs), band.shape[1]-nlo-1
+    for k in range(nsz):
+        for i in range(k+1, min(k+nlo+1, nsz)):
+            fac = band[i, k-i+nlo]/band[k, nlo]
+            if fac == 0.:
+                continue
+            for j in range(k, min(k+nup+1, nsz)):
+                band[i, j-i+nlo] = band[i, j-i+nlo] - fac*band[k, j-k+nlo]
+            rhs[i] = rhs[i] - fac*rhs[k]
+    for k in range(nsz-1, -1, -1):
+        for j in range(k+1, min(k+nup+1, nsz)):
+            rhs[k] = rhs[k] - band[k, j-k+nlo]*rhs[j]
+        rhs[k] = rhs[k]/band[k, nlo]
+    return rhs
+
+
+def _evaluate(qpm, summary, kidx, discount):
+    """Value of policy kidx, solving (I - discount*P) v = r."""
+
+    # Next states are n+Q (capped at M) without sending, and n-P+Q with
+    # sending. So I - discount*P is banded, with P-Q sub-diagonals and Q
+    # super-diagonals, and is diagonally dominant.
+    _, (ftheta, gtheta), _ = summary
+    q, p, m = qpm
+    sidx = np.arange(m-q+1)
+    band = np.zeros((m-q+1, p+1), np.float64)
+    band[:, p-q] = 1.0
+    psend = np.zeros(m-q+1, np.float64)
+    psend[(p-q):] = ftheta[kidx]
+    nxt = np.minimum(sidx+q, m-q)
+    band[sidx, nxt-sidx+p-q] -= discount*(1-psend)
+    band[sidx[(p-q):], 0] -= discount*psend[(p-q):]
+
+    rhs = np.zeros(m-q+1, np.float64)
+    rhs[(p-q):] = gtheta[kidx]
+    return _bandsolve(band, p-q, rhs)
+
+
+def _initvalue(qpm, summary, init, discount):
+    """Initial value vector from previous mdp info, or value/policy vector."""
+    if init is None:
+        return None
+    if isinstance(init, dict):
+        vidx = np.arange(qpm[0], qpm[2]+1, dtype=np.float64)/qpm[1]
+        return np.interp(vidx, init['vidx'], init['value'])
+    if len(init) == qpm[2]-qpm[0]+1:
+        return np.array(init, np.float64)
+    assert len(init) == qpm[2]-qpm[1]+1
+    kidx = np.searchsorted(-summary[0], -np.float64(init), side='right')
+    return _evaluate(qpm, summary, np.maximum(0, kidx-1), discount)
+
+
+def _policyiter(qpm, summary, value, discount, itparam):
+    """Howard policy iteration from value (zero if None) for one bucket."""
+    metrics = summary[0]
+    thresh = np.amax(np.abs(metrics))*itparam[1]
+    if value is None:
+        value = np.zeros((qpm[2]-qpm[0]+1), np.float64)
+    _, kidx = _bellman(qpm, summary, value, discount)
+    for nits in range(1, int(itparam[0])+1):
+        value = _evaluate(qpm, summary, kidx, discount)
+        tvalue, knew = _bellman(qpm, summary, value, discount)
+        resid = np.max(np.abs(tvalue-value))
+        if np.max(np.abs(metrics[knew]-metrics[kidx])) < thresh:
+            break
+        kidx = knew
+    return metrics[kidx], value, nits, resid
+
+
+@prof.timed()
+def mdp(rate, bdepth, traindata, discount=0.9999, itparam=(1e4, 1e-6),
+        method='vi', init=None, retinfo=False):
+    """
+    Find optimal policy thresholds given token bucket parameters.
+
+    method is one of 'vi' (value iteration), 'pi' (Howard policy iteration),
+    or 'rvi' (relative value iteration for average reward, ignores
+    discount). init warm-starts the solver with an info dictionary returned
+    by a previous call (possibly for a different bucket), or with a value or
+    policy vector for this bucket. If retinfo is True, also returns a
+    dictionary with iterations, residual, time, and final value vector.
+    """
+
+    qpm = ut.getqpm(rate, bdepth)
+    assert qpm[0] < qpm[1]
+    assert qpm[2] >= qpm[1]
+
+    tstart = perf_counter()
+    summary = _summarize(traindata)
+    metrics = summary[0]
+    thresh = np.amax(np.abs(metrics))*itparam[1]
+    value = _initvalue(qpm, summary, init, discount)
+
+    if method == 'vi':
+        policy, value, nits = _solve([qpm], summary, discount, itparam,
+                                     value)
+        policy, value = policy[0], value[0]
+        tvalue, _ = _bellman(qpm, summary, value, discount)
+        resid = np.max(np.abs(tvalue-value))
+
+    elif method == 'pi':
+        policy, value, nits, resid = _policyiter(qpm, summary, value,
+                                                 discount, itparam)
+
+    elif method == 'rvi':
+        # Average-reward backups, damped by half to avoid oscillations on
+        # periodic chains, and made relative to the full bucket state.
+        # Stops when the span of the backup's change is below threshold.
+        if value is None:
+            value = np.zeros((qpm[2]-qpm[0]+1), np.float64)
+        value = value-value[-1]
+        for nits in range(1, int(itparam[0])+1):
+            tvalue, kidx = _bellman(qpm, summary, value, 1.0)
+            resid = np.ptp(tvalue-value)
+            value = 0.5*(value+tvalue)
+            value, policy = value-value[-1], metrics[kidx]
+            if resid < thresh:
                 break
 
-    return policy
+    else:
+        raise ValueError("Unknown method %s" % method)
+
+    prof.note(iters=nits, states=int(qpm[2]-qpm[0]+1))
+
+    if not retinfo:
+        return policy
+
+    info = {'method': method, 'iters': nits, 'residual': resid,
+            'time': perf_counter()-tstart, 'value': value,
+            'vidx': np.arange(qpm[0], qpm[2]+1, dtype=np.float64)/qpm[1]}
+    return policy, info
+
+
+@prof.timed()
+def mdp_batch(rates, bdepths, traindata,
+              discount=0.9999, itparam=(1e4, 1e-6)):
+    """
+    Find optimal policies for many token bucket parameters at once.
+
+    Training data is sorted and summarized once, and all buckets are
+    solved together. Returns a dictionary mapping each (rate, bdepth)
+    pair in zip(rates, bdepths) to its policy vector.
+    """
+    qpms = [ut.getqpm(_r, _b) for _r, _b in zip(rates, bdepths)]
+    for qpm in qpms:
+        assert qpm[0] < qpm[1]
+        assert qpm[2] >= qpm[1]
+
+    uqpms = sorted(set(qpms))
+    policies, _, nits = _solve(uqpms, _summarize(traindata), discount,
+                               itparam)
+    prof.note(iters=nits, states=sum(int(_m-_q+1) for _q, _, _m in uqpms))
+    policies = dict(zip(uqpms, policies))
+    return {(_r, _b): policies[qpm]
+            for _r, _b, qpm in zip(rates, bdepths, qpms)}
@@ -0,0 +1,205 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Opt-in profiling of library calls and tasks, across processes."""
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+
+# Directory to write records to, or None to disable profiling. Must be set
+# before eomdp is imported.
+PATH = os.environ.get('EOMDP_PROF') or None
+RUN = None  # Id of this run, shared by all processes started from it
+if PATH is not None:
+    RUN = os.environ.setdefault('EOMDP_PROF_RUN', '%s-%d' % (
+        time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+_STACK = []  # Records of calls in progress, innermost last
+_FOBJ = [None, None]  # Record file of this process, and its pid
+
+
+def memory():
+    """Current and peak resident memory of this process in MB."""
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status') as fobj:
+            mem = dict(_l.split(':', 1) for _l in fobj)
+        return int(mem['VmRSS'].split()[0])/2**10, \
+            int(mem['VmHWM'].split()[0])/2**10
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss/2**20 if sys.platform == 'darwin' else rss/2**10
+    return rss, rss
+
+
+def resetpeak():
+    """Reset peak resident memory to current (only supported on Linux)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fobj:
+            fobj.write('5')
+    except OSError:
+        pass
+
+
+def _write(rec):
+    """Append record to the file of this process."""
+    if _FOBJ[1] != os.getpid():
+        os.makedirs(PATH, exist_ok=True)
+        _FOBJ[0] = open(os.path.join(PATH, '%s-%d.jsonl'
+                                     % (RUN, os.getpid())), 'a')
+        _FOBJ[1] = os.getpid()
+    _FOBJ[0].write(json.dumps(rec) + '\n')
+    _FOBJ[0].flush()
+
+
+def _record(label, args, func, fargs, kwargs):
+    """Call func, and write record of time and peak memory under label."""
+    rec = {'name': label}
+    if args:
+        rec['args'] = repr(fargs)
+
+    # Peak memory of the caller so far is saved before it is reset.
+    if _STACK:
+        _STACK[-1]['peak_mb'] = max(_STACK[-1]['peak_mb'], memory()[1])
+    resetpeak()
+    rec['peak_mb'] = 0.
+    _STACK.append(rec)
+    tstart = time.perf_counter()
+    try:
+        return func(*fargs, **kwargs)
+    finally:
+        rec['time'] = time.perf_counter()-tstart
+        _STACK.pop()
+        rec['peak_mb'] = max(rec['peak_mb'], memory()[1])
+        if _STACK:
+            _STACK[-1]['peak_mb'] = max(_STACK[-1]['peak_mb'],
+                                        rec['peak_mb'])
+        _write(rec)
+
+
+def timed(name=None, args=False):
+    """
+    Decorator to record wall time and peak memory of every call of a
+    function, under name (module.function by default), along with the
+    repr of its positional arguments if args is True. Returns the function
+    unchanged if profiling is disabled.
+    """
+    def wrap(func):
+        if PATH is None:
+            return func
+        label = name or '%s.%s' % (func.__module__.split('.')[-1],
+                                   func.__qualname__)
+
+        @functools.wraps(func)
+        def call(*fargs, **kwargs):
+            return _record(label, args, func, fargs, kwargs)
+        call.label = label
+        return call
+    return wrap
+
+
+def kernel(func):
+    """
+    Wrap a compiled kernel to record its calls, with the first call for new
+    argument types (which compiles or loads it from the cache) recorded
+    separately. Returns the kernel unchanged if profiling is disabled.
+    """
+    if PATH is None:
+        return func
+    label = 'kernels.' + func.__name__
+
+    def call(*fargs):
+        return _record(label, False, _checkjit,
+                       (func, len(func.signatures)) + fargs, {})
+    return call
+
+
+def _checkjit(func, nsig, *fargs):
+    """Call func, and mark record if it added a compiled signature."""
+    out = func(*fargs)
+    if len(func.signatures) > nsig:
+        _STACK[-1]['name'] = _STACK[-1]['name'] + ' (first call)'
+    return out
+
+
+def note(**fields):
+    """Add numeric fields (e.g., iterations) to record of current call."""
+    if not _STACK:
+        return
+    for key, val in fields.items():
+        _STACK[-1][key] = _STACK[-1].get(key, 0) + val
+
+
+def load(path=PATH, run=None):
+    """
+    Return list of records in directory path, of run (the current run if
+    None, or the latest if there is no current run), or of all runs if run
+    is 'all'.
+    """
+    if not os.path.isdir(path):
+        return []
+    files = sorted(_f for _f in os.listdir(path) if _f.endswith('.jsonl'))
+    if run is None:
+        run = RUN or ('-'.join(files[-1].split('-')[:3]) if files else '')
+    recs = []
+    for fname in files:
+        if run == 'all' or fname.startswith(run + '-'):
+            with open(os.path.join(path, fname)) as fobj:
+                recs.extend(json.loads(_l) for _l in fobj)
+    return recs
+
+
+def summary(records):
+    """
+    Aggregate records by name, and return list of dictionaries with the
+    number of calls, total, mean, and max time, max peak memory, and the
+    mean of other fields (over calls that noted them), sorted by decreasing
+    total time.
+    """
+    groups = {}
+    for rec in records:
+        groups.setdefault(rec['name'], []).append(rec)
+
+    rows = []
+    for name, recs in groups.items():
+        times = [_r['time'] for _r in recs]
+        row = {'name': name, 'calls': len(recs), 'total': sum(times),
+               'mean': sum(times)/len(recs), 'max': max(times),
+               'peak_mb': max(_r['peak_mb'] for _r in recs)}
+        for key in sorted({_k for _r in recs for _k in _r} -
+                          {'name', 'args', 'time', 'peak_mb'}):
+            vals = [_r[key] for _r in recs if key in _r]
+            row[key] = sum(vals)/len(vals)
+        rows.append(row)
+    return sorted(rows, key=lambda _r: -_r['total'])
+
+
+def report(path=PATH, run=None, out=None):
+    """Print summary of records of run (see load) in directory path."""
+    out = out or sys.stdout
+    rows = summary(load(path, run))
+    out.write("%-36s %6s %9s %9s %9s %8s  %s\n" % (
+        'name', 'calls', 'total(s)', 'mean(s)', 'max(s)', 'peak(MB)',
+        'mean per call'))
+    for row in rows:
+        extra = ['%s=%.4g' % (_k, _v) for _k, _v in row.items()
+                 if _k not in ['name', 'calls', 'total', 'mean', 'max',
+                               'peak_mb']]
+        out.write("%-36s %6d %9.3f %9.4f %9.4f %8.1f  %s\n" % (
+            row['name'], row['calls'], row['total'], row['mean'],
+            row['max'], row['peak_mb'], ' '.join(extra)))
+
+
+def times(path=PATH):
+    """
+    Return dictionary of the longest time of calls recorded with arguments
+    (across all runs in path), keyed by (name, repr of arguments). Using
+    the longest time ignores calls that returned early with results that
+    were already saved.
+    """
+    longest = {}
+    for rec in load(path, 'all'):
+        if 'args' in rec:
+            key = (rec['name'], rec['args'])
+            longest[key] = max(longest.get(key, 0.), rec['time'])
+    return longest
@@ -0,0 +1,136 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Run tasks with dependencies in parallel, skipping those up to date."""
+
+import os
+import json
+import heapq
+import hashlib
+from queue import SimpleQueue
+from multiprocessing import Pool
+from numba import set_num_threads
+
+
+def digest(*items):
+    """Return hex digest of the repr of items."""
+    return hashlib.sha1(repr(items).encode()).hexdigest()
+
+
+def filedigest(path, bsz=2**24):
+    """Return hex digest of the contents of a file."""
+    hsh = hashlib.sha1()
+    with open(path, 'rb') as fobj:
+        for blk in iter(lambda: fobj.read(bsz), b''):
+            hsh.update(blk)
+    return hsh.hexdigest()
+
+
+def _hashes(tasks):
+    """Combine digest of each task with hashes of its dependencies."""
+    hashes = {}
+
+    def _hash(tid):
+        if tid not in hashes:
+            hashes[tid] = digest(tasks[tid][4],
+                                 sorted(_hash(_d) for _d in tasks[tid][2]))
+        return hashes[tid]
+
+    for tid in tasks:
+        _hash(tid)
+    return hashes
+
+
+def _readlog(logpath):
+    """Return dictionary of task hashes recorded at logpath."""
+    if not os.path.exists(logpath):
+        return {}
+    with open(logpath) as fobj:
+        return json.load(fobj)
+
+
+def _writelog(logpath, log):
+    """Atomically replace log of task hashes."""
+    with open(logpath + '.tmp', 'w') as fobj:
+        json.dump(log, fobj, indent=0, sort_keys=True)
+    os.replace(logpath + '.tmp', logpath)
+
+
+def pending(tasks, logpath):
+    """Return set of ids of tasks in tasks (see run) that need to be run."""
+    log, hashes = _readlog(logpath), _hashes(tasks)
+    return {_t for _t in tasks if log.get(_t) != hashes[_t]}
+
+
+def _initworker(initializer, initargs):
+    """Limit worker to one thread for compiled kernels, and initialize it."""
+    set_num_threads(1)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run(tasks, logpath, processes=None, initializer=None, initargs=()):
+    """
+    Run tasks in a pool of processes, where tasks is a dictionary mapping
+    each (string) task id to a tuple (func, params, deps, cost, dgst, clean):
+
+    - func(params) is called in a worker to run the task.
+    - deps is a list of ids of tasks that need to finish before this one.
+    - cost is the expected running time (in arbitrary units). Among tasks
+      whose dependencies are done, those with the highest cost start first.
+    - dgst is a digest (see digest) of the inputs of the task. This is
+      combined with the hashes of its dependencies, and recorded in logpath
+      after the task is done. Tasks whose hash matches the recorded one are
+      skipped.
+    - clean() is called (if not None) before re-running a task with a
+      different recorded hash, to remove its stale results.
+
+    Workers are started with initializer(*initargs), and run compiled
+    kernels with a single thread each. A task starts as soon as all its
+    dependencies are done. If a task fails,
+    tasks that depend on it are not run, and a RuntimeError is raised after
+    all other tasks are done.
+    """
+    log, hashes = _readlog(logpath), _hashes(tasks)
+    todo = {_t for _t in tasks if log.get(_t) != hashes[_t]}
+
+    nwait, children = {}, {}
+    for tid in todo:
+        nwait[tid] = 0
+        for dep in tasks[tid][2]:
+            if dep in todo:
+                nwait[tid] += 1
+                children.setdefault(dep, []).append(tid)
+    ready = [(-tasks[_t][3], _t) for _t in todo if nwait[_t] == 0]
+    heapq.heapify(ready)
+
+    nproc = processes or os.cpu_count()
+    done, failed, nrun = SimpleQueue(), [], 0
+    with Pool(nproc, _initworker, (initializer, initargs)) as pool:
+        while ready or nrun:
+            # Keep only nproc tasks queued, so later ones can go first.
+            while ready and nrun < nproc:
+                tid = heapq.heappop(ready)[1]
+                func, params, _, _, _, clean = tasks[tid]
+                if tid in log and clean is not None:
+                    clean()
+                pool.apply_async(
+                    func, (params,),
+                    callback=lambda _, t=tid: done.put((t, None)),
+                    error_callback=lambda e, t=tid: done.put((t, e)))
+                nrun += 1
+
+            tid, err = done.get()
+            nrun -= 1
+            if err is not None:
+                print("Failed %s: %r" % (tid, err))
+                failed.append(tid)
+                continue
+
+            log[tid] = hashes[tid]
+            _writelog(logpath, log)
+            for child in children.get(tid, []):
+                nwait[child] -= 1
+                if nwait[child] == 0:
+                    heapq.heappush(ready, (-tasks[child][3], child))
+
+    if failed:
+        raise RuntimeError("%d tasks failed: %s" % (len(failed), failed))
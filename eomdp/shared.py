@@ -0,0 +1,94 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Datasets loaded once and shared read-only by multiprocessing workers."""
+
+from multiprocessing import shared_memory
+import numpy as np
+from numba import set_num_threads
+from .store import keyval
+
+_ALIGN = 64
+_DSETS = {}  # Datasets available in this process, by (table, key)
+_SHMS = []  # Shared memory blocks backing views in _DSETS
+
+
+def _dkey(table, key):
+    """Hashable identifier of a dataset."""
+    return (table, tuple(sorted((k, keyval(v)) for k, v in key.items())))
+
+
+def _derive(dset):
+    """Add reward arrays (weak - strong cost) to dataset."""
+    dset = dict(dset)
+    for split in ['tr', 'ts']:
+        if 'wcost_'+split in dset:
+            dset['reward_'+split] = dset['wcost_'+split]-dset['scost_'+split]
+    return dset
+
+
+def get(res, table, **key):
+    """
+    Return dictionary of arrays stored in table of Store res with parameters
+    key, with added reward_tr and reward_ts arrays. Returns read-only views of
+    shared memory if the dataset was shared with this process by attach, and
+    otherwise loads it only once per process.
+    """
+    dkey = _dkey(table, key)
+    if dkey not in _DSETS:
+        _DSETS[dkey] = _derive(res.get(table, **key))
+    return _DSETS[dkey]
+
+
+def attach(spec):
+    """
+    Pool initializer to use datasets shared by a Shared object. Also limits
+    compiled kernels to one thread, since the pool already uses all cores.
+    """
+    set_num_threads(1)
+    shm = shared_memory.SharedMemory(name=spec[0])
+    _SHMS.append(shm)
+    for dkey, arrays in spec[1]:
+        dset = {}
+        for name, dtype, shape, off in arrays:
+            dset[name] = np.ndarray(shape, dtype, shm.buf, off)
+            dset[name].flags.writeable = False
+        _DSETS[dkey] = dset
+
+
+class Shared:
+    """
+    Copies datasets from table of Store res with each parameter dictionary
+    in keys (along with derived rewards) into a single shared memory block.
+    Pass initializer=attach, initargs=(obj.spec,) to Pool, so that workers
+    get views of this block from get. Use as a context manager, or call close
+    to free the block when done.
+    """
+
+    def __init__(self, res, table, keys):
+        dsets = [(_dkey(table, _k), _derive(res.get(table, **_k)))
+                 for _k in keys]
+
+        layout, size = [], 0
+        for dkey, dset in dsets:
+            arrays = []
+            for name, arr in dset.items():
+                arr = np.asarray(arr)
+                arrays.append((name, arr.dtype.str, arr.shape, size))
+                size += -(-arr.nbytes // _ALIGN) * _ALIGN
+            layout.append((dkey, arrays))
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for (_, dset), (_, arrays) in zip(dsets, layout):
+            for name, dtype, shape, off in arrays:
+                np.ndarray(shape, dtype, self.shm.buf, off)[...] = dset[name]
+        self.spec = (self.shm.name, layout)
+
+    def close(self):
+        """Free shared memory block."""
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
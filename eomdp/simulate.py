@@ -2,103 +2,386 @@
 """Functions for simulating sending with a given policy."""
 
 import numpy as np
-from numba import jit
+from numba import get_num_threads
+from . import prof
 from . import utils as ut
+from . import kernels as kn
+from .kernels import _rngstates
 
+_simulate, _mcsimulate, _mcsimulate_many, _fleetsimulate, _gth = [
+    prof.kernel(_k) for _k in [kn._simulate, kn._mcsimulate,
+                               kn._mcsimulate_many, kn._fleetsimulate,
+                               kn._gth]]
 
-@jit(nopython=True)
-def _simulate(qpm, policy, dset_mr, rsz_is):
-    """Compiled implementation of simulate."""
+_SEQBATCH = 10000  # Steps per stream between checks of sequential stopping
+_ARBITERS = ['fixed', 'roundrobin', 'random']
 
-    assert qpm[0] < qpm[1]
-    assert qpm[2] >= qpm[1]
-    assert len(policy) == qpm[2]-qpm[1]+1
 
-    send_m = np.zeros((len(dset_mr[0]), 2), np.int64)
-    send_s = np.zeros((qpm[2]-qpm[1]+1), np.float64)
-    scmp = np.arange(qpm[1], qpm[2]+1).reshape((-1, 1))
-    occup_s = np.zeros((qpm[2]-qpm[0]+1), np.float64)
-    ocmp = np.arange(qpm[0], qpm[2]+1).reshape((-1, 1))
+def _seed(seed):
+    """Integer seed from None (random), an integer, or a numpy Generator."""
+    if seed is None:
+        return np.random.randint(2**31)
+    if isinstance(seed, np.random.Generator):
+        return int(seed.integers(2**62))
+    return int(seed)
 
-    nstate = qpm[2]*np.ones((rsz_is[1]), np.int64)
-    imidx = np.random.randint(0, len(dset_mr[0]), rsz_is)
-    avg_gain = 0.
 
-    for i in range(rsz_is[0]):
-        tidx = imidx[i, :]
+def _runbatches(run, gains, rsz_is, tol, rtol, ninp=1):
+    """
+    Call run(nsteps) for rsz_is[0] steps in all, in batches of _SEQBATCH
+    steps if tol or rtol is given, and stop early once the standard error of
+    per-stream average gains (over ninp inputs per step) is below tol, or
+    below rtol times the mean gain. Returns the number of steps run and the
+    standard error, which is NaN if neither tol nor rtol is given, or if
+    there is only one stream (which then runs for all rsz_is[0] steps).
+    """
+    seqstop = (tol is not None or rtol is not None) and len(gains) > 1
+    done, stderr = 0, np.nan
+    while done < rsz_is[0]:
+        nsteps = rsz_is[0]-done
+        if seqstop:
+            nsteps = min(nsteps, _SEQBATCH)
+        run(nsteps)
+        done = done + nsteps
+        if not seqstop:
+            continue
 
-        ifsend = dset_mr[0][tidx] >= policy[np.maximum(0, nstate-qpm[1])]
-        ifsend = np.logical_and(ifsend, nstate >= qpm[1])
+        gmean = np.mean(gains)/(done*ninp)
+        stderr = np.std(gains/(done*ninp), ddof=1)/np.sqrt(len(gains))
+        if tol is not None and stderr <= tol:
+            break
+        if rtol is not None and stderr <= rtol*np.abs(gmean):
+            break
+    return done, stderr
 
-        occup_s = occup_s + np.sum(ocmp == nstate, 1)
-        send_s = send_s + np.sum(scmp == nstate[ifsend], 1)
-        for j, jidx in enumerate(tidx):
-            send_m[jidx, 1] = send_m[jidx, 1] + 1
-            if ifsend[j]:
-                send_m[jidx, 0] = send_m[jidx, 0] + 1
 
-        avg_gain = avg_gain + np.sum(np.where(ifsend, dset_mr[1][tidx], 0))
-        nstate = nstate - np.where(ifsend, qpm[1], 0) + qpm[0]
-        nstate = np.minimum(nstate, qpm[2])
+def _tokenchain(qpm, psend):
+    """
+    Stationary distribution of token states, when an input is sent with
+    probability psend[n-Q] in each state n.
+    """
+    # Next states are n+Q (capped at M) without sending, and n-P+Q with
+    # sending, so the transition matrix is banded with P-Q sub-diagonals and
+    # Q super-diagonals.
+    q, p, m = qpm
+    sidx = np.arange(m-q+1)
+    band = np.zeros((m-q+1, p+1), np.float64)
+    band[sidx, np.minimum(sidx+q, m-q)-sidx+p-q] = 1-psend
+    band[sidx[(p-q):], 0] = psend[(p-q):]
+    return _gth(band, p-q)
 
+
+def _stationary(qpm, policy, dset_mr):
+    """
+    Stationary distribution of token states under policy, with send
+    probabilities and expected rewards in each state.
+    """
+
+    metrics, rewards = dset_mr
+    idx = np.argsort(metrics)
+    metrics, rewards = metrics[idx], np.float64(rewards[idx])
+    rsum = np.concatenate((np.cumsum(rewards[::-1])[::-1], [0.]))
+
+    # Inputs are sent in states n >= P if their metrics exceed the threshold,
+    # i.e. if they are at sorted positions >= pos.
+    pos = np.full(qpm[2]-qpm[0]+1, len(metrics), np.int64)
+    pos[(qpm[1]-qpm[0]):] = np.searchsorted(metrics, policy, side='left')
+    psend = (len(metrics)-pos)/len(metrics)
+    rsend = rsum[pos]/len(metrics)
+
+    return _tokenchain(qpm, psend), psend, rsend, pos
+
+
+def _simulate_exact(qpm, policy, dset_mr, rsz_is):
+    """Expected simulate outputs from stationary distribution."""
+
+    occup_s, psend, rsend, pos = _stationary(qpm, policy, dset_mr)
+    avg_gain = np.sum(occup_s*rsend)
+    send_s = (occup_s*psend)[(qpm[1]-qpm[0]):]
+
+    nsamp, denom = len(dset_mr[0]), rsz_is[0]*rsz_is[1]
+    send_m = np.zeros((nsamp, 2), np.float64)
+    send_m[:, 1] = denom/nsamp
+    send_m[:, 0] = np.cumsum(np.bincount(pos, occup_s, nsamp+1))[:-1] * \
+        denom/nsamp
+    return avg_gain, (send_m, send_s, occup_s)
+
+
+@prof.timed()
+def simulate(rate, bdepth, policy, dset_mr, rsz_is=(1e5, 1e2), seed=None,
+             method='mc', tol=None, rtol=None):
+    """
+    Simulate policy on a single camera.
+
+    With method='exact', returns expected values under the stationary
+    distribution of the token bucket Markov chain instead. If a target
+    standard error tol, or relative standard error rtol, is given, stops
+    as soon as it is reached (with rsz_is[0] as the maximum number of
+    steps), and also returns (standard error, steps per stream), which is
+    (0.0, 0) with method='exact'.
+    """
+
+    qpm = ut.getqpm(rate, bdepth)
+    rsz_is = (int(rsz_is[0]), int(rsz_is[1]))
+    prof.note(states=int(qpm[2]-qpm[0]+1))
+    if method == 'exact':
+        result = _simulate_exact(qpm, np.float64(policy), dset_mr, rsz_is)
+        if tol is None and rtol is None:
+            return result
+        return result + ((0.0, 0),)
+    assert method == 'mc'
+
+    nblk = min(rsz_is[1], get_num_threads())
+    itype = kn.counttype(rsz_is[0]*rsz_is[1])
+    hists = (np.zeros((nblk, len(dset_mr[0]), 2), itype),
+             np.zeros((nblk, qpm[2]-qpm[1]+1), itype),
+             np.zeros((nblk, qpm[2]-qpm[0]+1), itype))
+    nstate = np.full(rsz_is[1], qpm[2], itype)
+    rngs = _rngstates(_seed(seed), rsz_is[1])
+    gains = np.zeros((rsz_is[1]), np.float64)
+    dset_mr = kn.data(dset_mr)
+    qpm, policy = kn.frozen(qpm, np.int64), kn.frozen(policy, np.float64)
+
+    def run(nsteps):
+        _simulate(qpm, policy, dset_mr, nsteps, nstate, rngs, gains, hists)
+    nsteps, stderr = _runbatches(run, gains, rsz_is, tol, rtol)
+    prof.note(steps=nsteps*rsz_is[1])
+
+    send_m, send_s, occup_s = [np.sum(_h, 0) for _h in hists]
     send_m = send_m[np.argsort(dset_mr[0]), :]
 
-    denom = rsz_is[0]*rsz_is[1]
+    denom = nsteps*rsz_is[1]
     occup_s, send_s = occup_s/denom, send_s/denom
-    return avg_gain/denom, (send_m, send_s, occup_s)
+    if tol is None and rtol is None:
+        return np.sum(gains)/denom, (send_m, send_s, occup_s)
+    return np.sum(gains)/denom, (send_m, send_s, occup_s), (stderr, nsteps)
 
 
-def simulate(rate, bdepth, policy, dset_mr, rsz_is=(1e5, 1e2)):
-    """Simulate policy on a single camera."""
+@prof.timed()
+def mcapprox(rb_i, rb_g, ncam, policy, dset_mr):
+    """
+    Approximate mcsimulate with a mean-field model of the switch.
 
-    qpm = ut.getqpm(rate, bdepth)
+    Devices are assumed to send independently with the stationary send
+    probability of their own token bucket chain, and the switch bucket is
+    solved as a Markov chain over arrivals from devices. Since the switch
+    bucket is refilled at each arrival, this chain is the same for any
+    number of devices, and ncam is unused (it is kept so that calls match
+    mcsimulate). Returns the approximate average reward and switch
+    occupancy distribution.
+    """
+
+    qpm_i, qpm_g = ut.getqpm(*rb_i), ut.getqpm(*rb_g)
+    occup_i, psend_i, rsend_i, _ = _stationary(qpm_i, np.float64(policy),
+                                               dset_mr)
+
+    # A sent input is accepted if the switch has enough tokens.
+    psend_g = np.zeros(qpm_g[2]-qpm_g[0]+1, np.float64)
+    psend_g[(qpm_g[1]-qpm_g[0]):] = np.sum(occup_i*psend_i)
+    occup_g = _tokenchain(qpm_g, psend_g)
+
+    paccept = np.sum(occup_g[(qpm_g[1]-qpm_g[0]):])
+    return np.sum(occup_i*rsend_i)*paccept, occup_g
+
+
+@prof.timed()
+def mcsimulate(rb_i, rb_g, ncam, policy, dset_mr, rsz_is=(1e5, 1e2),
+               seed=None, tol=None, rtol=None):
+    """
+    Simulate policy on multiple cameras interacting with a switch.
+
+    Like simulate, stops early if a target (relative) standard error tol
+    (rtol) is reached, and then also returns (standard error, steps).
+    """
+
+    qpm_i, qpm_g = np.int64(ut.getqpm(*rb_i)), np.int64(ut.getqpm(*rb_g))
     rsz_is = (int(rsz_is[0]), int(rsz_is[1]))
-    return _simulate(qpm, policy, dset_mr, rsz_is)
 
+    nblk = min(rsz_is[1], get_num_threads())
+    itype = kn.counttype(rsz_is[0]*rsz_is[1]*ncam)
+    occup_s = np.zeros((nblk, qpm_g[2]-qpm_g[0]+1), itype)
+    nistate = np.full(rsz_is[1]*ncam, qpm_i[2], itype)
+    ngstate = np.full(rsz_is[1], qpm_g[2], itype)
+    rngs = _rngstates(_seed(seed), rsz_is[1])
+    gains = np.zeros((rsz_is[1]), np.float64)
+    dset_mr = kn.data(dset_mr)
+    qpm_i, qpm_g = kn.frozen(qpm_i, np.int64), kn.frozen(qpm_g, np.int64)
+    policy = kn.frozen(policy, np.float64)
 
-@jit(nopython=True)
-def _mcsimulate(qpm_i, qpm_g, ncam, policy, dset_mr, rsz_is):
-    """Compiled implementation of mcsimulate."""
+    def run(nsteps):
+        _mcsimulate(qpm_i, qpm_g, ncam, policy, dset_mr, nsteps,
+                    nistate, ngstate, rngs, gains, occup_s)
+    nsteps, stderr = _runbatches(run, gains, rsz_is, tol, rtol, ncam)
+    prof.note(states=int(qpm_g[2]-qpm_g[0]+1), steps=nsteps*rsz_is[1]*ncam)
 
-    assert qpm_i[0] < qpm_i[1]
-    assert qpm_i[2] >= qpm_i[1]
-    assert len(policy) == qpm_i[2]-qpm_i[1]+1
-    assert qpm_g[0] < qpm_g[1]
-    assert qpm_g[2] >= qpm_g[1]
+    denom = nsteps*rsz_is[1]*ncam
+    if tol is None and rtol is None:
+        return np.sum(gains)/denom, np.sum(occup_s, 0)/denom
+    return np.sum(gains)/denom, np.sum(occup_s, 0)/denom, (stderr, nsteps)
 
-    occup_s = np.zeros((qpm_g[2]-qpm_g[0]+1), np.float64)
-    ocmp = np.arange(qpm_g[0], qpm_g[2]+1).reshape((-1, 1))
 
-    imidx = np.random.randint(0, len(dset_mr[0]), (rsz_is[0], rsz_is[1]*ncam))
-    nistate = qpm_i[2]*np.ones((rsz_is[1]*ncam), np.int64)
-    ngstate = qpm_g[2]*np.ones((rsz_is[1]), np.int64)
-    avg_gain = 0.
+@prof.timed()
+def fleetsimulate(rb_list, rb_g, ncams, policies, dsets, arbiter='fixed',
+                  rsz_is=(1e5, 1e2), seed=None, tol=None, rtol=None):
+    """
+    Simulate a fleet of cameras of K classes interacting with a switch.
 
-    for i in range(rsz_is[0]):
-        tidx = imidx[i, :]
+    Class k has ncams[k] > 0 devices, with per-device (rate, bdepth)
+    rb_list[k], policy vector policies[k], and inputs sampled from dataset
+    dsets[k] (a tuple of metrics and rewards, which can be shared by
+    classes). At each
+    step, devices reach the switch in a fixed order, an order rotated by one
+    every step ('roundrobin'), or a random order ('random'), as set by
+    arbiter. Returns the average reward (per input of all devices), (K,)
+    average rewards of devices in each class, and the switch occupancy
+    distribution. Like simulate, stops early if a target (relative) standard
+    error tol (rtol) is reached, and then also returns (standard error,
+    steps).
+    """
 
-        ifsend = dset_mr[0][tidx] >= policy[np.maximum(0, nistate-qpm_i[1])]
-        ifsend = np.logical_and(ifsend, nistate >= qpm_i[1])
-        nistate = nistate - np.where(ifsend, qpm_i[1], 0) + qpm_i[0]
-        nistate = np.minimum(nistate, qpm_i[2])
+    assert len(ncams) == len(rb_list)
+    assert min(ncams) > 0
+    qpms_i = np.int64([ut.getqpm(*_rb) for _rb in rb_list])
+    qpm_g = np.int64(ut.getqpm(*rb_g))
+    rsz_is = (int(rsz_is[0]), int(rsz_is[1]))
+    devcls = np.repeat(np.arange(len(ncams)), ncams)
+    ndev = len(devcls)
 
-        for j in range(ncam):
-            occup_s = occup_s + np.sum(ocmp == ngstate, 1)
+    ptab = np.full((len(rb_list), max([len(_p) for _p in policies])),
+                   np.inf)
+    for k, _p in enumerate(policies):
+        assert len(_p) == qpms_i[k, 2]-qpms_i[k, 1]+1
+        ptab[k, :len(_p)] = _p
 
-            ifsendj, tidxj = ifsend[j::ncam], tidx[j::ncam]
-            ifsendj = np.logical_and(ifsendj, ngstate >= qpm_g[1])
-            avg_gain = avg_gain + \
-                np.sum(np.where(ifsendj, dset_mr[1][tidxj], 0))
-            ngstate = ngstate - np.where(ifsendj, qpm_g[1], 0) + qpm_g[0]
-            ngstate = np.minimum(ngstate, qpm_g[2])
+    # Datasets are concatenated (once each if shared) into a single buffer.
+    uniq, doffs, size = {}, np.zeros((len(dsets), 2), np.int64), 0
+    for k, _d in enumerate(dsets):
+        if id(_d) not in uniq:
+            uniq[id(_d)] = (_d, size)
+            size = size + len(_d[0])
+        doffs[k] = uniq[id(_d)][1], uniq[id(_d)][1] + len(_d[0])
+    dset_mr = kn.data(tuple(np.concatenate([_d[i] for _d, _ in
+                                            uniq.values()])
+                            for i in range(2)))
 
-    denom = rsz_is[0]*rsz_is[1]*ncam
-    return avg_gain/denom, occup_s/denom
+    nblk = min(rsz_is[1], get_num_threads())
+    itype = kn.counttype(rsz_is[0]*rsz_is[1]*ndev)
+    occup_s = np.zeros((nblk, qpm_g[2]-qpm_g[0]+1), itype)
+    nistate = np.ascontiguousarray(
+        np.broadcast_to(np.asarray(qpms_i[devcls, 2], itype),
+                        (rsz_is[1], ndev)))
+    ngstate = np.full(rsz_is[1], qpm_g[2], itype)
+    order = np.repeat(np.arange(ndev)[np.newaxis], rsz_is[1], 0)
+    rngs = _rngstates(_seed(seed), rsz_is[1])
+    gains = np.zeros((rsz_is[1], len(rb_list)), np.float64)
+    totals = np.zeros(rsz_is[1], np.float64)
+    qpms_i, devcls = kn.frozen(qpms_i, np.int64), kn.frozen(devcls, np.int64)
+    qpm_g, ptab = kn.frozen(qpm_g, np.int64), kn.frozen(ptab, np.float64)
+    doffs, done = kn.frozen(doffs, np.int64), [0]
 
+    def run(nsteps):
+        _fleetsimulate(qpms_i, devcls, qpm_g, ptab, doffs, dset_mr, nsteps,
+                       done[0], _ARBITERS.index(arbiter), nistate, ngstate,
+                       order, rngs, gains, occup_s)
+        done[0] = done[0] + nsteps
+        totals[:] = np.sum(gains, 1)
+    nsteps, stderr = _runbatches(run, totals, rsz_is, tol, rtol, ndev)
+    prof.note(states=int(qpm_g[2]-qpm_g[0]+1), steps=nsteps*rsz_is[1]*ndev)
 
-def mcsimulate(rb_i, rb_g, ncam, policy, dset_mr, rsz_is=(1e5, 1e2)):
-    """Simulate policy on multiple cameras interacting with a switch."""
+    denom = nsteps*rsz_is[1]
+    result = (np.sum(totals)/(denom*ndev),
+              np.sum(gains, 0)/(denom*np.float64(ncams)),
+              np.sum(occup_s, 0)/(denom*ndev))
+    if tol is None and rtol is None:
+        return result
+    return result + ((stderr, nsteps),)
 
-    qpm_i, qpm_g = ut.getqpm(*rb_i), ut.getqpm(*rb_g)
+
+@prof.timed()
+def mcsimulate_many(rb_list, policies, rb_g, ncam, dset_mr,
+                    rsz_is=(1e5, 1e2), seed=None, perstream=False):
+    """
+    Simulate many per-device (rate, bdepth) candidates with one switch.
+
+    rb_list is a list of K (rate_i, bdepth_i) tuples, and policies the list
+    of corresponding policy vectors. All candidates are simulated on the
+    same sampled inputs (common random numbers). Returns (K,) average gains
+    (or (K, streams) per-stream gains if perstream is True), and a (K,
+    M_g-Q_g+1) array of switch occupancy distributions.
+    """
+
+    qpms_i = np.int64([ut.getqpm(*_rb) for _rb in rb_list])
+    qpm_g = np.int64(ut.getqpm(*rb_g))
     rsz_is = (int(rsz_is[0]), int(rsz_is[1]))
-    return _mcsimulate(qpm_i, qpm_g, ncam, policy, dset_mr, rsz_is)
+
+    ptab = np.full((len(rb_list), max([len(_p) for _p in policies])),
+                   np.inf)
+    for k, _p in enumerate(policies):
+        ptab[k, :len(_p)] = _p
+
+    ncand = len(rb_list)
+    itype = kn.counttype(rsz_is[0]*rsz_is[1]*ncam)
+    occup_s = np.zeros((ncand, qpm_g[2]-qpm_g[0]+1), itype)
+    nistate = np.repeat(np.asarray(qpms_i[:, 2:3], itype), rsz_is[1]*ncam, 1)
+    ngstate = np.full((ncand, rsz_is[1]), qpm_g[2], itype)
+    gains = np.zeros((ncand, rsz_is[1]), np.float64)
+    dset_mr = kn.data(dset_mr)
+    _mcsimulate_many(kn.frozen(qpms_i, np.int64), kn.frozen(qpm_g, np.int64),
+                     ncam, kn.frozen(ptab, np.float64), dset_mr, rsz_is[0],
+                     nistate, ngstate, _rngstates(_seed(seed), rsz_is[1]),
+                     gains, occup_s, min(ncand, get_num_threads()))
+
+    prof.note(states=int(qpm_g[2]-qpm_g[0]+1),
+              steps=rsz_is[0]*rsz_is[1]*ncam*ncand)
+    denom = rsz_is[0]*ncam
+    gains, occup_s = gains/denom, occup_s/(denom*rsz_is[1])
+    return (gains if perstream else np.mean(gains, 1)), occup_s
+
+
+@prof.timed()
+def mcsearch(rb_list, policies, rb_g, ncam, dset_mr, rsz_is=(1e5, 1e2),
+             seed=None, rsz0=1e3, growth=4, zval=3.0, nprior=None):
+    """
+    Find best per-device (rate, bdepth) in rb_list by adaptive simulation.
+
+    Starts all candidates with simulations of rsz0 steps per stream, and
+    after each round drops candidates whose mean difference in gain from the
+    leader (paired across streams, since all share the same inputs) is
+    below zero by more than zval standard errors. Survivors are simulated
+    for growth times longer, up to rsz_is[0] steps. If nprior is given, only
+    the nprior candidates with the highest rewards from mcapprox are
+    simulated. Returns (K,) gains of candidates that survive to full-length
+    simulation (NaN for pruned ones), and the index of the best candidate.
+    Standard errors are estimated across streams, so rsz_is[1] must be at
+    least 2.
+    """
+
+    seed = _seed(seed)
+    rsz_is = (int(rsz_is[0]), int(rsz_is[1]))
+    assert rsz_is[1] >= 2
+    active = np.arange(len(rb_list))
+    if nprior is not None and nprior < len(rb_list):
+        prior = [mcapprox(_rb, rb_g, ncam, _p, dset_mr)[0]
+                 for _rb, _p in zip(rb_list, policies)]
+        active = np.sort(np.argsort(prior)[::-1][:nprior])
+    nsteps = min(int(rsz0), rsz_is[0])
+    while True:
+        gains, _ = mcsimulate_many([rb_list[k] for k in active],
+                                   [policies[k] for k in active], rb_g,
+                                   ncam, dset_mr, (nsteps, rsz_is[1]), seed,
+                                   True)
+        if nsteps >= rsz_is[0]:
+            break
+
+        leader = np.argmax(np.mean(gains, 1))
+        diffs = gains - gains[leader, :]
+        dmean = np.mean(diffs, 1)
+        dstd = np.std(diffs, 1, ddof=1)/np.sqrt(rsz_is[1])
+        keep = dmean + zval*dstd >= 0
+        keep[leader] = True
+        active = active[keep]
+        nsteps = min(nsteps*int(growth), rsz_is[0])
+
+    scores = np.full(len(rb_list), np.nan)
+    scores[active] = np.mean(gains, 1)
+    return scores, active[np.argmax(scores[active])]
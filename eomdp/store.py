@@ -0,0 +1,136 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Single-file store of experiment results keyed by parameters."""
+
+import io
+import os
+import sqlite3
+import numpy as np
+from . import prof
+
+
+def keyval(val):
+    """Parameter value as stored, rounded so that float keys match."""
+    return round(float(val), 9)
+
+
+def _pack(values):
+    """Serialize dictionary of arrays to bytes."""
+    buf = io.BytesIO()
+    np.savez(buf, **values)
+    return buf.getvalue()
+
+
+def _unpack(blob):
+    """Deserialize bytes written by _pack to dictionary of arrays."""
+    with np.load(io.BytesIO(blob)) as npz:
+        return {k: npz[k] for k in npz.files}
+
+
+class Store:
+    """
+    Results stored in a single sqlite database, with one table per
+    experiment. Each row is keyed by named numeric parameters, and holds a
+    dictionary of numpy arrays. Safe to use from multiple processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._con, self._pid, self._tables = None, None, {}
+
+    def _conn(self):
+        """Connection for this process (re-opened after a fork)."""
+        if self._pid != os.getpid():
+            self._con = sqlite3.connect(self.path, timeout=600)
+            self._con.execute('PRAGMA journal_mode=WAL')
+            self._pid, self._tables = os.getpid(), {}
+        return self._con
+
+    def _table(self, table, keys):
+        """Create table with key columns keys if needed."""
+        con = self._conn()
+        if table not in self._tables:
+            cols = ', '.join(['"%s" REAL' % k for k in keys])
+            con.execute('CREATE TABLE IF NOT EXISTS "%s" (%s, data BLOB, '
+                        'PRIMARY KEY (%s))'
+                        % (table, cols,
+                           ', '.join(['"%s"' % k for k in keys])))
+            self._tables[table] = sorted(keys)
+        assert self._tables[table] == sorted(keys)
+        return con
+
+    def _where(self, key):
+        """SQL condition and arguments to match (partial) key."""
+        if not key:
+            return '', []
+        return ' WHERE ' + ' AND '.join(['"%s"=?' % k for k in key]), \
+            [keyval(v) for v in key.values()]
+
+    def put(self, table, values, **key):
+        """Store dictionary values of arrays with parameters key."""
+        con = self._table(table, list(key))
+        with con:
+            con.execute('INSERT OR REPLACE INTO "%s" (%s, data) VALUES (%s)'
+                        % (table, ', '.join(['"%s"' % k for k in key]),
+                           ', '.join(['?']*(len(key)+1))),
+                        [keyval(v) for v in key.values()] + [_pack(values)])
+
+    def putmany(self, table, rows):
+        """Store list of (key dictionary, values dictionary) together."""
+        if not rows:
+            return
+        keys = list(rows[0][0])
+        con = self._table(table, keys)
+        with con:
+            con.executemany(
+                'INSERT OR REPLACE INTO "%s" (%s, data) VALUES (%s)'
+                % (table, ', '.join(['"%s"' % k for k in keys]),
+                   ', '.join(['?']*(len(keys)+1))),
+                [[keyval(_k[k]) for k in keys] + [_pack(_v)]
+                 for _k, _v in rows])
+
+    def delete(self, table, **key):
+        """Remove all results whose parameters match the (partial) key."""
+        if not self._exists(table):
+            return
+        where, args = self._where(key)
+        con = self._conn()
+        with con:
+            con.execute('DELETE FROM "%s"%s' % (table, where), args)
+
+    def _exists(self, table):
+        """Check if table exists."""
+        return self._conn().execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+            (table,)).fetchone() is not None
+
+    def has(self, table, **key):
+        """Check if results with parameters key are present."""
+        if not self._exists(table):
+            return False
+        where, args = self._where(key)
+        return self._conn().execute('SELECT 1 FROM "%s"%s LIMIT 1'
+                                    % (table, where), args).fetchone() \
+            is not None
+
+    def get(self, table, **key):
+        """Return dictionary of arrays with parameters key, or None."""
+        rows = self.select(table, **key)
+        return rows[1][0] if rows[1] else None
+
+    @prof.timed()
+    def select(self, table, **key):
+        """
+        Return all results whose parameters match the (partial) key, as a
+        dictionary of arrays of all parameter values, and a list of the
+        corresponding dictionaries of result arrays.
+        """
+        if not self._exists(table):
+            return {}, []
+        where, args = self._where(key)
+        cur = self._conn().execute('SELECT * FROM "%s"%s' % (table, where),
+                                   args)
+        names = [_d[0] for _d in cur.description][:-1]
+        rows = cur.fetchall()
+        keys = {k: np.float64([_r[i] for _r in rows])
+                for i, k in enumerate(names)}
+        return keys, [_unpack(_r[-1]) for _r in rows]
@@ -0,0 +1,70 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Seeded synthetic data resembling OFA classifier outputs, for benchmarks."""
+
+import numpy as np
+
+
+def _ranks(rng, boost, ncls, step=4096):
+    """
+    Return logits with noise and the ground truth class (0) boosted, and the
+    rank of the ground truth in each row, computed in chunks of step rows.
+    """
+    logits = np.zeros((len(boost), ncls), np.float32)
+    ranks = np.zeros(len(boost), np.int64)
+    for i in range(0, len(boost), step):
+        lgt = rng.standard_normal((len(boost[i:i+step]), ncls), np.float32)
+        lgt[:, 0] += np.float32(boost[i:i+step])
+        logits[i:i+step] = lgt
+        ranks[i:i+step] = 1 + np.sum(lgt[:, 1:] > lgt[:, :1], 1)
+    return logits, ranks
+
+
+def dataset(nsamp=50000, ncls=1000, nfold=3, seed=0):
+    """
+    Return dictionary with the same arrays as ofa_imgnet.npz, for nsamp
+    samples and ncls classes: weak classifier logits wlogit, ground truth
+    labels gt, ranks wrank and srank of the ground truth in weak and strong
+    classifier outputs, and fold index split.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Per-sample difficulty, shared by both classifiers, so that weak and
+    # strong errors are correlated (with about 75% and 85% top-1 accuracy).
+    hard = rng.random(nsamp)
+    wlogit, wrank = _ranks(rng, 1.0+4.0*(1-hard)**0.3, ncls)
+    _, srank = _ranks(rng, 1.5+4.0*(1-hard)**0.3, ncls)
+
+    # Move ground truth logit from column 0 to a random label.
+    gtl = rng.integers(ncls, size=nsamp)
+    rows = np.arange(nsamp)
+    wlogit[rows, 0], wlogit[rows, gtl] = wlogit[rows, gtl], wlogit[rows, 0]
+    return {'wlogit': wlogit, 'gt': gtl, 'wrank': wrank, 'srank': srank,
+            'split': rng.integers(nfold, size=nsamp)}
+
+
+def entropies(nsamp=33333, seed=0):
+    """
+    Return (entropies, rewards) of nsamp samples, with rewards (weak minus
+    strong cost) in {-1, 0, 1} more likely to be positive at high entropy.
+    """
+    rng = np.random.default_rng(seed)
+    entr = np.minimum(rng.gamma(2.0, 0.7, nsamp), np.log(1000))
+    pwrong = 1/(1+np.exp(-2*(entr-1.5)))
+    rewards = np.float64(rng.random(nsamp) < pwrong) - \
+        np.float64(rng.random(nsamp) < 0.05)
+    return entr, rewards
+
+
+def metrics(nsamp=33333, seed=0):
+    """
+    Return (metrics, rewards) of nsamp samples, with metrics equal to the
+    expected reward given entropy, like those mapped by fitmetric.
+    """
+    entr, rewards = entropies(nsamp, seed)
+    return 1/(1+np.exp(-2*(entr-1.5))) - 0.05, rewards
+
+
+def rbgrid(rates=(0.05, 0.5, 19), bdepths=(1.0, 10.0, 37)):
+    """List of (rate, bdepth) for linspace ranges of rates and bdepths."""
+    return [(_r, _b) for _b in np.linspace(*bdepths)
+            for _r in np.linspace(*rates)]
@@ -0,0 +1,99 @@
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Simulation of policies on recorded traces of frames."""
+
+import os
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+from . import prof
+from . import utils as ut
+from . import kernels as kn
+
+_replay = prof.kernel(kn._replay)
+
+_NAMES = ['metric', 'reward', 'camera']  # Arrays of a trace directory
+
+
+def _read(path, chunk):
+    """
+    Yield consecutive chunks of at most chunk values of 1-D npy file path,
+    read into a buffer that is re-used for every chunk.
+    """
+    header = np.load(path, mmap_mode='r')
+    assert header.ndim == 1
+    dtype, size, offset = header.dtype, len(header), header.offset
+    del header
+
+    buf = np.empty(min(chunk, size), dtype)
+    with open(path, 'rb') as fobj:
+        fobj.seek(offset)
+        for idx in range(0, size, chunk):
+            nval = min(chunk, size-idx)
+            nread = fobj.readinto(memoryview(buf[:nval]).cast('B'))
+            assert nread == nval*dtype.itemsize
+            yield buf[:nval]
+
+
+def chunks(trace, chunk=2**20):
+    """
+    Yield tuples of (metrics, rewards) or (metrics, rewards, cameras) for
+    consecutive chunks of at most chunk frames of trace, which is a
+    directory of npy files or a tuple of (possibly memory-mapped) arrays.
+    Files are read into fixed buffers, so memory use does not grow with
+    the length of the trace.
+    """
+    if not isinstance(trace, str):
+        for idx in range(0, len(trace[0]), chunk):
+            yield tuple(_a[idx:(idx+chunk)] for _a in trace)
+        return
+
+    paths = [os.path.join(trace, _n + '.npy') for _n in _NAMES]
+    yield from zip(*[_read(_p, chunk) for _p in paths if os.path.exists(_p)])
+
+
+@prof.timed()
+def replay(rate, bdepth, policy, trace, ncam=1, chunk=2**20):
+    """
+    Simulate policy on the frames of a recorded trace in order, with a
+    (rate, bdepth) token bucket (starting full) for each of ncam cameras.
+
+    trace is a directory with metric.npy, reward.npy, and (optionally, for
+    frames of many cameras) camera.npy with camera ids in [0, ncam), or a
+    tuple of these arrays. Frames are processed in chunks, with bucket
+    states carried over. Returns the average reward per frame, (ncam,)
+    average rewards per frame of each camera, and (send_s, occup_s) as for
+    simulate.
+    """
+
+    qpm = kn.frozen(ut.getqpm(rate, bdepth), np.int64)
+    policy = kn.frozen(policy, np.float64)
+    nstate = np.full(ncam, qpm[2], np.int64)
+    gains = np.zeros(ncam, np.float64)
+    counts = np.zeros(ncam, np.int64)
+    send_s = np.zeros(qpm[2]-qpm[1]+1, np.int64)
+    occup_s = np.zeros(qpm[2]-qpm[0]+1, np.int64)
+    nocams = kn.frozen(np.zeros(0), np.int64)
+
+    for frames in chunks(trace, chunk):
+        cams = nocams
+        if len(frames) > 2:
+            cams = kn.frozen(frames[2], np.int32 if frames[2].dtype ==
+                             np.int32 else np.int64)
+        _replay(qpm, policy, *kn.data(frames[:2]), cams, nstate, gains,
+                counts, send_s, occup_s)
+
+    total = np.sum(counts)
+    prof.note(states=int(qpm[2]-qpm[0]+1), steps=int(total))
+    return np.sum(gains)/total, gains/np.maximum(counts, 1), \
+        (send_s/total, occup_s/total)
+
+
+def replay_many(rate, bdepth, policy, traces, processes=None, **kwargs):
+    """
+    Call replay for each trace in the list traces, in parallel across
+    processes, and return the list of results. Optional keyword arguments
+    are passed to replay.
+    """
+    with mp.get_context('spawn').Pool(processes) as pool:
+        return pool.map(partial(replay, rate, bdepth, policy, **kwargs),
+                        traces, chunksize=1)
@@ -1,7 +1,9 @@
 # - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
 """Utility functions for calibration and cost & entropy computation."""
 
+from functools import lru_cache
 import numpy as np
+from . import prof
 
 _COSTS = ['Top1-Error', 'Top5-Error', 'Rank']
 
@@ -16,36 +18,110 @@ def cost(wrank, srank, ctype=0):
         np.float64(np.minimum(10, srank))
 
 
-def entropy(logits, tinv):
+@prof.timed()
+def entropy(logits, tinv, memlimit=2**28):
     """Compute entropy from logits + calibration temperature."""
-    logits = np.float64(np.transpose(logits))
-    lnum = tinv*(logits - np.max(logits, 0))
-    pden = np.sum(np.exp(lnum), 0)
 
-    return - np.sum(np.exp(lnum)*lnum, 0)/pden + np.log(pden)
-
-
-def calib(logits, gtlbl, _lb=0.0, _ub=2.0, _crounds=6):
-    """Calibrate logits to find best factor that minimizes x-entropy."""
-    logits, gtlbl = np.float32(logits), np.int64(gtlbl)
-    logits = logits - np.max(logits, 1, keepdims=True)
-    base = -np.mean(logits[np.arange(len(gtlbl)), gtlbl])
+    # Process rows in float32 chunks of at most memlimit bytes of
+    # temporaries, with a single exp per chunk.
+    step = max(1, int(memlimit // (logits.shape[1]*4*4)))
+    ent = np.zeros(len(logits), np.float64)
+    for idx in range(0, len(logits), step):
+        lnum = np.float32(logits[idx:(idx+step)])
+        lnum = np.float32(tinv)*(lnum - np.max(lnum, 1, keepdims=True))
+        wts = np.exp(lnum)
+        pden = np.sum(wts, 1)
+        ent[idx:(idx+step)] = np.log(pden) - np.sum(wts*lnum, 1)/pden
+
+    return ent
+
+
+def _calibsums(logits, gtlbl, tinvs, memlimit, newton):
+    """
+    Stream over rows of logits in chunks that fit in memlimit bytes, and
+    return mean cross-entropy at each of tinvs, or (if newton) its first and
+    second derivatives at the single value tinvs[0].
+    """
+    rowbytes = logits.shape[1]*4*(5 if newton else 2*len(tinvs)+2)
+    step = max(1, int(memlimit // rowbytes))
+
+    sums = np.zeros((2 if newton else len(tinvs)), np.float64)
+    for idx in range(0, len(gtlbl), step):
+        lgt = np.float32(logits[idx:(idx+step)])
+        lgt = lgt - np.max(lgt, 1, keepdims=True)
+        lgt_gt = lgt[np.arange(len(lgt)), np.int64(gtlbl[idx:(idx+step)])]
+        if newton:
+            wts = np.exp(tinvs[0]*lgt)
+            pden = np.sum(wts, 1)
+            mean1 = np.sum(wts*lgt, 1)/pden
+            mean2 = np.sum(wts*lgt*lgt, 1)/pden
+            sums[0] = sums[0] + np.sum(mean1 - lgt_gt)
+            sums[1] = sums[1] + np.sum(mean2 - mean1*mean1)
+        else:
+            sums = sums - tinvs*np.sum(lgt_gt, dtype=np.float64) + \
+                np.sum(np.log(np.sum(np.exp(tinvs*lgt[:, :, np.newaxis]), 1)),
+                       0, dtype=np.float64)
+
+    return sums / len(gtlbl)
+
+
+@prof.timed()
+def calib(logits, gtlbl, _lb=0.0, _ub=2.0, _crounds=6,
+          method='grid', memlimit=2**28):
+    """
+    Calibrate logits to find best factor that minimizes x-entropy.
+
+    Logits are streamed in row chunks so that temporaries stay within
+    memlimit bytes. method='grid' refines a 10-point grid over [_lb,_ub] for
+    _crounds rounds, while method='newton' does safeguarded Newton steps on
+    the (convex) cross-entropy above _lb, with one pass per step. Like the
+    grid window, the Newton bracket is widened past _ub while the derivative
+    there is still negative.
+    """
+
+    if method == 'newton':
+        best, upper = np.clip(1.0, _lb, _ub), np.inf
+        for nits in range(1, 21):
+            grad, hess = _calibsums(logits, gtlbl, np.float32([best]),
+                                    memlimit, True)
+            if grad > 0:
+                upper = best
+            else:
+                _lb = best
+            step = grad/hess if hess > 0 else np.inf
+            if _lb < best - step < upper:
+                best = best - step
+            elif upper < np.inf:
+                step, best = best - (_lb+upper)/2, (_lb+upper)/2
+            else:
+                _ub = max(2*_ub, 2*best)
+                step, best = best - _ub, _ub
+            if np.abs(step) < 1e-5:
+                break
+        prof.note(iters=nits)
+        return np.float32(best)
 
     for _ in range(_crounds):
         tinvs = np.linspace(_lb, _ub, 10, dtype=np.float32)
-        xent = base*tinvs + np.mean(np.log(
-            np.sum(np.exp(tinvs*logits[:, :, np.newaxis]), 1)
-        ), 0)
+        xent = _calibsums(logits, gtlbl, tinvs, memlimit, False)
 
         best = tinvs[np.argmin(xent)]
         _lb = np.maximum(0., best - tinvs[1] + tinvs[0])
         _ub = best + tinvs[1] - tinvs[0]
 
+    prof.note(iters=_crounds)
     return best
 
 
 def getqpm(rate, bdepth, maxp=100):
     """Return integer (q,p,m) such that q/p ~ rate, m/p ~ bdepth."""
+    return _getqpm(np.asarray(rate, np.float64).item(),
+                   np.asarray(bdepth, np.float64).item(), int(maxp))
+
+
+@lru_cache(maxsize=4096)
+def _getqpm(rate, bdepth, maxp):
+    """Cached getqpm for recently used (float) rate and bdepth."""
     denom = np.arange(maxp, dtype=np.int64)+1
     rerr, berr = denom*rate, denom*bdepth
     err = (rerr-np.floor(rerr)+berr-np.floor(berr))/denom
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Run all experiments in dependency order, re-running only changed tasks."""
+
+import os
+from statistics import median
+from eomdp import ingest
+from eomdp import kernels
+from eomdp import prof
+from eomdp import sched
+from eomdp import shared
+from eomdp import store
+from eomdp import utils as ut
+import runtest_fmetric as fm
+import runtest_single as single
+import runtest_robust as robust
+import runtest_mcpolicies as mcp
+import runtest_mcsim as mcs
+import runtest_mcam as mcam
+
+RES = store.Store('save/results.db')
+LOG = 'save/tasks.json'  # Hashes of inputs of completed tasks
+SIMSTEPS = 1e7  # Default number of steps (x streams) of simulations
+MDPCOST = 1e5  # Cost of mdp per state relative to a simulation step
+
+
+def nstates(rate, bdepth):
+    """Number of token states of the MDP for (rate, bdepth)."""
+    qpm = ut.getqpm(rate, bdepth)
+    return int(qpm[2]-qpm[0]+1)
+
+
+def onecost(rate, bdepth, simmethod):
+    """Cost of single camera test (for three folds)."""
+    cost = MDPCOST*nstates(rate, bdepth)
+    if simmethod == 'mc':
+        cost = cost + 2*SIMSTEPS
+    return 3*cost
+
+
+def gettasks():
+    """Return dictionary of all tasks for sched.run."""
+    if os.path.exists(fm.DSET):
+        data = sched.filedigest(fm.DSET)
+    else:
+        data = sched.digest(*[sched.filedigest(os.path.join(fm.MDIR, _f))
+                              for _f in sorted(os.listdir(fm.MDIR))])
+
+    tasks = {}
+    for fold, cost in fm.PLIST:
+        tasks['fm%s' % ((fold, cost),)] = (
+            fm.runtest, (fold, cost), [], 0, sched.digest(data, fold, cost),
+            lambda f=fold, c=cost: RES.delete('fm', fold=f, cost=c))
+
+    def fmdeps(cost):
+        return ['fm%s' % ((_f, cost),) for _f in range(3)]
+
+    for prm in single.PLIST:
+        rate, bdepth, cost = prm
+        tasks['1cam%s' % (prm,)] = (
+            single.runtest, prm, fmdeps(cost),
+            onecost(rate, bdepth, single.SIMMETHOD),
+            sched.digest(prm, single.SIMMETHOD),
+            lambda r=rate, b=bdepth, c=cost:
+            RES.delete('1cam', rate=r, bdepth=b, cost=c))
+
+    for prm in robust.PLIST:
+        rate, bdepth, cost, dev = prm
+        tasks['1cam_dev%s' % (prm,)] = (
+            robust.runtest, prm, fmdeps(cost),
+            onecost(rate, bdepth, robust.SIMMETHOD),
+            sched.digest(prm, robust.SIMMETHOD),
+            lambda r=rate, b=bdepth, c=cost, d=dev:
+            RES.delete('1cam_dev', rate=r, bdepth=b, cost=c, dev=d))
+
+    pidx = {}
+    for prm in mcp.PLIST:
+        fold, rates, bdepth, cost = prm
+        tid = 'mcp%s' % (prm,)
+        for rate in rates:
+            pidx[(fold, store.keyval(rate), store.keyval(bdepth), cost)] = tid
+        tasks[tid] = (
+            mcp.runtest, prm, ['fm%s' % ((fold, cost),)],
+            MDPCOST*sum(nstates(_r, bdepth) for _r in rates),
+            sched.digest(prm),
+            lambda f=fold, rs=rates, b=bdepth, c=cost:
+            [RES.delete('mcp', rate=_r, bdepth=b, fold=f, cost=c)
+             for _r in rs])
+
+    def mcpdeps(fold, rb_list, cost):
+        return [pidx[(fold, store.keyval(_r), store.keyval(_b), cost)]
+                for _r, _b in rb_list]
+
+    # Exhaustive simulations are only used by mcam if it does not search.
+    for prm in mcs.PLIST if not mcam.ADAPTIVE else []:
+        fold, r_g, b_p, ncam, cost = prm
+        rb_list = mcs.candidates(r_g, b_p)
+        tasks['mcs%s' % (prm,)] = (
+            mcs.runtest, prm,
+            sorted(set(mcpdeps(fold, rb_list, cost)))
+            + ['fm%s' % ((fold, cost),)],
+            SIMSTEPS*ncam*len(rb_list), sched.digest(prm, mcam.ADAPTIVE),
+            lambda f=fold, rg=r_g, bp=b_p, nc=ncam, c=cost:
+            RES.delete('mcs', rg=rg, bp=bp, ncam=nc, fold=f, cost=c))
+
+    for prm in mcam.PLIST:
+        r_g, b_p, ncam, cost = prm
+        rb_list = mcs.candidates(r_g, b_p)
+        # Three final simulations per fold, and mcsearch costs about as
+        # much as full simulations of a tenth of the candidates.
+        nsims = 3 + (len(rb_list)/10 if mcam.ADAPTIVE else 0)
+        rb_list = rb_list + [(r_g, b_p), (r_g, b_p*ncam)]
+        deps = set(fmdeps(cost))
+        for fold in range(3):
+            deps.update(mcpdeps(fold, rb_list, cost))
+            if not mcam.ADAPTIVE:
+                deps.add('mcs%s' % ((fold, r_g, b_p, ncam, cost),))
+        tasks['mcam%s' % (prm,)] = (
+            mcam.runtest, prm, sorted(deps), 3*SIMSTEPS*ncam*nsims,
+            sched.digest(prm, mcam.ADAPTIVE, mcam.NPRIOR,
+                         mcam.RIS, mcam.BIS),
+            lambda rg=r_g, bp=b_p, nc=ncam, c=cost:
+            RES.delete('mcam', rg=rg, bp=bp, ncam=nc, cost=c))
+
+    return tasks
+
+
+def measured(tasks):
+    """
+    Replace cost estimates of tasks with their times recorded by prof (in
+    any earlier run), rescaled to the units of the estimates.
+    """
+    times = prof.times()
+    found = {}
+    for tid, task in tasks.items():
+        key = (getattr(task[0], 'label', None), repr((task[1],)))
+        if key in times and times[key] > 0:
+            found[tid] = times[key]
+    ratios = [tasks[_t][3]/found[_t] for _t in found if tasks[_t][3] > 0]
+    if not ratios:
+        return tasks
+    scale = median(ratios)
+    return {_t: _v[:3] + (found[_t]*scale if _t in found else _v[3],) + _v[4:]
+            for _t, _v in tasks.items()}
+
+
+if __name__ == "__main__":
+    if not os.path.isdir(fm.MDIR):
+        ingest.convert(fm.DSET, fm.MDIR)
+    TASKS = gettasks()
+    if prof.PATH:
+        TASKS = measured(TASKS)
+    kernels.precompile()
+
+    # Share fitted metrics with workers if they are not going to change.
+    FMKEYS = [{'fold': f, 'cost': c} for f, c in fm.PLIST]
+    if any(_t.startswith('fm') for _t in sched.pending(TASKS, LOG)):
+        sched.run(TASKS, LOG)
+    else:
+        with shared.Shared(RES, 'fm', FMKEYS) as shm:
+            sched.run(TASKS, LOG, initializer=shared.attach,
+                      initargs=(shm.spec,))
+    if prof.PATH:
+        prof.report()
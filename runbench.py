@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Benchmark time and memory of library functions on synthetic data."""
+
+import os
+import sys
+import json
+import time
+import platform
+import multiprocessing as mp
+import numpy as np
+from eomdp import prof
+from eomdp import synth
+
+OPATH = 'save/bench.json'
+BASEPATH = 'save/bench_base.json'  # Created from first run if missing
+NREP = 3  # Repetitions after a first call, reporting the fastest
+MAXTIME = 10  # Stop repetitions after this many seconds
+TTOL = 0.2  # Flag if slower than baseline by this fraction
+MTOL = (0.2, 16)  # Flag if peak memory increases by fraction and MB
+NSAMP, NCLS = 50000, 1000
+RB = (0.1, 2.0)
+
+
+def _calib():
+    from eomdp import utils as ut
+    dset = synth.dataset(NSAMP, NCLS)
+    return lambda: ut.calib(dset['wlogit'], dset['gt'])
+
+
+def _entropy():
+    from eomdp import utils as ut
+    dset = synth.dataset(NSAMP, NCLS)
+    return lambda: ut.entropy(dset['wlogit'], 2.0)
+
+
+def _fitmetric():
+    from eomdp import policy as po
+    entr, rewards = synth.entropies(NSAMP*2//3)
+    return lambda: po.fitmetric(entr, rewards)
+
+
+def _mdp(bdepth):
+    from eomdp import policy as po
+    tdata = synth.metrics(NSAMP*2//3)
+    return lambda: po.mdp(RB[0], bdepth, tdata)
+
+
+def _simulate():
+    from eomdp import policy as po
+    from eomdp import simulate as sim
+    tdata = synth.metrics(NSAMP*2//3)
+    policy = po.mdp(*RB, tdata)
+    return lambda: sim.simulate(*RB, policy, tdata, seed=0)
+
+
+def _mcsimulate(ncam):
+    from eomdp import policy as po
+    from eomdp import simulate as sim
+    tdata = synth.metrics(NSAMP*2//3)
+    policy = po.mdp(*RB, tdata)
+    return lambda: sim.mcsimulate(RB, (RB[0], RB[1]*ncam), ncam,
+                                  policy, tdata, seed=0)
+
+
+def _fleet(ndev):
+    from eomdp import policy as po
+    from eomdp import simulate as sim
+    tdata = [synth.metrics(NSAMP*2//3), synth.metrics(NSAMP//3, seed=1)]
+    rb_list = [RB, (RB[0]/2, RB[1]*2)]
+    policies = [po.mdp(*_rb, _t) for _rb, _t in zip(rb_list, tdata)]
+    return lambda: sim.fleetsimulate(
+        rb_list, (RB[0], RB[1]*ndev), [ndev//2, ndev-ndev//2], policies,
+        tdata, 'random', (1e5*8//ndev, 1e2), seed=0)
+
+
+def _replay():
+    from eomdp import policy as po
+    from eomdp import trace
+    tdata = synth.metrics(NSAMP*2//3)
+    policy = po.mdp(*RB, tdata)
+    idx = np.random.default_rng(0).integers(len(tdata[0]), size=10**7)
+    frames = (np.float32(tdata[0][idx]), np.float32(tdata[1][idx]),
+              np.int32(idx % 8))
+    return lambda: trace.replay(*RB, policy, frames, 8)
+
+
+BENCHES = {'calib': _calib,
+           'entropy': _entropy,
+           'fitmetric': _fitmetric,
+           **{'mdp_b%d' % _b: (lambda b=_b: _mdp(b)) for _b in [1, 4, 16]},
+           'simulate': _simulate,
+           **{'mcsimulate_nc%d' % _n: (lambda n=_n: _mcsimulate(n))
+              for _n in [2, 4, 8]},
+           'fleet_nd256': lambda: _fleet(256),
+           'replay': _replay}
+
+
+def _run(name, queue):
+    """Run benchmark name (in a fresh process), and put results in queue."""
+    func = BENCHES[name]()
+    prof.resetpeak()
+    rss0 = prof.memory()[0]
+    tstart = time.perf_counter()
+    func()
+    first = time.perf_counter()-tstart
+
+    times = []
+    while len(times) < NREP and sum(times)+first < MAXTIME:
+        tstart = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-tstart)
+    peak = prof.memory()[1]
+    queue.put({'time': min(times or [first]), 'first': first,
+               'peak_mb': peak, 'mem_mb': peak-rss0})
+
+
+def runbench(name):
+    """Return dictionary of results of benchmark name."""
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run, args=(name, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def compare(res, base):
+    """Return list of regressions of results res w.r.t. baseline base."""
+    regs = []
+    for name, cur in res.items():
+        if name not in base:
+            continue
+        old = base[name]
+        if cur['time'] > old['time']*(1+TTOL):
+            regs.append('%s: time %.3fs vs %.3fs' % (
+                name, cur['time'], old['time']))
+        if cur['mem_mb'] > old['mem_mb']*(1+MTOL[0])+MTOL[1]:
+            regs.append('%s: memory %.0fMB vs %.0fMB' % (
+                name, cur['mem_mb'], old['mem_mb']))
+    return regs
+
+
+if __name__ == "__main__":
+    NAMES = sys.argv[1:] or list(BENCHES)
+    BASE = {}
+    if os.path.exists(BASEPATH):
+        with open(BASEPATH) as fobj:
+            BASE = json.load(fobj)['results']
+
+    RES = {}
+    print("%-16s %9s %9s %9s %9s %7s" % ('benchmark', 'time(s)', 'first(s)',
+                                         'mem(MB)', 'peak(MB)', 'vs base'))
+    for _n in NAMES:
+        RES[_n] = runbench(_n)
+        print("%-16s %9.4f %9.4f %9.1f %9.1f %7s" % (
+            _n, RES[_n]['time'], RES[_n]['first'], RES[_n]['mem_mb'],
+            RES[_n]['peak_mb'], '%.2fx' % (RES[_n]['time']/BASE[_n]['time'])
+            if _n in BASE else '-'))
+
+    OUT = {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'host': platform.node(),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__, 'ncpu': os.cpu_count()},
+           'results': RES}
+    os.makedirs(os.path.dirname(OPATH), exist_ok=True)
+    with open(OPATH, 'w') as fobj:
+        json.dump(OUT, fobj, indent=1)
+    if not BASE:
+        with open(BASEPATH, 'w') as fobj:
+            json.dump(OUT, fobj, indent=1)
+        print("Saved baseline to %s" % BASEPATH)
+
+    REGS = compare(RES, BASE)
+    for _r in REGS:
+        print("REGRESSION " + _r)
+    sys.exit(1 if REGS else 0)
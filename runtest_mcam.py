@@ -4,15 +4,19 @@
 
 from multiprocessing import Pool
 import numpy as np
+from eomdp import kernels
 from eomdp import simulate as sim
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
+import runtest_mcsim as mcs
 
-FMPATH = 'save/fm_fold%d_cost%d.npz'
-PPATH = 'save/mcp_ri%03d_bi%04d_f%d_c%d.npy'
-SPATH = 'save/mcs_rg%03d_bp_%04d_nc%d_ri%03d_bi%04d_f%d_c%d.npz'
-BIS = [b/4 for b in range(4, 41)]  # Search range for per-device depth
-RIS = [r/40 for r in range(2, 21)]  # Search range for per-device rate
+RES = store.Store('save/results.db')
+RIS, BIS = mcs.RIS, mcs.BIS  # Search ranges for per-device rate, depth
 
 OPATH = 'save/mcam_rg%03d_bp%04d_nc%d_c%d.npz'
+ADAPTIVE = True  # Search (r_i, b_i) by adaptive simulation, not mcsim files
+NPRIOR = None  # If set, only simulate these many best (r_i, b_i) by mcapprox
 PLIST = [(rg, bp, ncam, cost)
          for rg in [0.05, 0.1, 0.25]
          for bp in [1, 2]
@@ -22,26 +26,20 @@ PLIST = [(rg, bp, ncam, cost)
 
 def loadpolicy(fold, ri_, bi_, cost):
     """Loads pre-computed policy."""
-    return np.load(PPATH % (int(ri_*1000), int(bi_*100), fold, cost))
+    return RES.get('mcp', rate=ri_, bdepth=bi_, fold=fold, cost=cost)['policy']
 
 
 def getscores(fold, r_g, b_p, ncam, cost):
     """Form matrix of training set simulation scores."""
 
-    scores = np.zeros((len(RIS), len(BIS)), np.float64)
-    for j, _b in enumerate(BIS):
-        for i, _r in enumerate(RIS):
-            if _r <= r_g and _b < b_p:
-                scores[i, j] = np.NAN
-                continue
-            if _r < r_g and _b <= b_p:
-                scores[i, j] = np.NAN
-                continue
-
-            sres = np.load(SPATH % (int(r_g*1000), int(b_p*100), ncam,
-                                    int(_r*1000), int(_b*100),
-                                    fold, cost))
-            scores[i, j] = sres['gain']
+    keys, vals = RES.select('mcs', rg=r_g, bp=b_p, ncam=ncam,
+                            fold=fold, cost=cost)
+    ridx = {store.keyval(_r): i for i, _r in enumerate(RIS)}
+    bidx = {store.keyval(_b): j for j, _b in enumerate(BIS)}
+
+    scores = np.full((len(RIS), len(BIS)), np.nan)
+    for _r, _b, _v in zip(keys['ri'], keys['bi'], vals):
+        scores[ridx[_r], bidx[_b]] = _v['gain']
 
     rbi = np.unravel_index(np.nanargmax(scores), scores.shape)
     rbi = (RIS[rbi[0]], BIS[rbi[1]])
@@ -49,22 +47,43 @@ def getscores(fold, r_g, b_p, ncam, cost):
     return scores, rbi
 
 
+def searchscores(fold, r_g, b_p, ncam, cost, tdata):
+    """Form matrix of training set scores by adaptive simulation."""
+
+    rb_list = mcs.candidates(r_g, b_p)
+    policies = mcs.loadpolicies(fold, rb_list, cost)
+    gains, best = sim.mcsearch(rb_list, policies, (r_g, b_p*ncam), ncam,
+                               tdata, nprior=NPRIOR)
+
+    scores = np.full((len(RIS), len(BIS)), np.nan)
+    for (_r, _b), gain in zip(rb_list, gains):
+        scores[RIS.index(_r), BIS.index(_b)] = gain
+
+    return scores, rb_list[best]
+
+
+@prof.timed('runtest_mcam', args=True)
 def runtest(params_rbnc):
     """Run test with (rate, per-cam bdepth, ncam, cost_idx)"""
 
     r_g, b_p, ncam, cost = params_rbnc
     b_g = b_p*ncam
+    if RES.has('mcam', rg=r_g, bp=b_p, ncam=ncam, cost=cost):
+        return
 
     npz = {'iso': 0.0, 'hier': 0.0, 'smart': 0.0}
     for fold in range(3):
-        dset = np.load(FMPATH % (fold, cost))
-        metr_ts = dset['metric_ts']
-        rew_ts = dset['wcost_ts']-dset['scost_ts']
+        dset = shared.get(RES, 'fm', fold=fold, cost=cost)
+        metr_ts, rew_ts = dset['metric_ts'], dset['reward_ts']
 
         iso_p = loadpolicy(fold, r_g, b_p, cost)
         smart_p = loadpolicy(fold, r_g, b_g, cost)
 
-        scores, rbi = getscores(fold, r_g, b_p, ncam, cost)
+        if ADAPTIVE:
+            scores, rbi = searchscores(fold, r_g, b_p, ncam, cost,
+                                       (dset['metric_tr'], dset['reward_tr']))
+        else:
+            scores, rbi = getscores(fold, r_g, b_p, ncam, cost)
         hier_p = loadpolicy(fold, rbi[0], rbi[1], cost)
 
         iso_g, iso_o = sim.mcsimulate((r_g, b_p), (r_g, b_g), ncam,
@@ -86,11 +105,17 @@ def runtest(params_rbnc):
             npz['hier_o'] = hier_o
             npz['smart_o'] = smart_o
 
+    RES.put('mcam', npz, rg=r_g, bp=b_p, ncam=ncam, cost=cost)
     np.savez_compressed(OPATH % (int(r_g*1000), int(b_p*100), ncam, cost),
                         **npz)
     print("Completed r_g=%f, b_p=%f, ncam=%d, cost=%d" % params_rbnc)
 
 
 if __name__ == "__main__":
-    with Pool() as p:
+    kernels.precompile()
+    with shared.Shared(RES, 'fm', [{'fold': f, 'cost': c} for f in range(3)
+                                   for c in [1]]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
         p.map(runtest, PLIST, chunksize=1)
+    if prof.PATH:
+        prof.report()
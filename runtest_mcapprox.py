@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# - Ayan Chakrabarti <ayan.chakrabarti@gmail.com>
+"""Compare mean-field approximation to simulation for multiple cameras."""
+
+from multiprocessing import Pool
+import numpy as np
+from eomdp import kernels
+from eomdp import simulate as sim
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
+from runtest_mcsim import loadpolicies, candidates
+
+RES = store.Store('save/results.db')
+PLIST = [(f, rg, bp, ncam, c)
+         for ncam in range(2, 9)
+         for rg in [0.05, 0.1, 0.25]
+         for bp in [1, 2]
+         for f in [0]
+         for c in [1]]
+
+
+@prof.timed('runtest_mcapprox', args=True)
+def runtest(params):
+    """Run test with (fold, output (r,b), ncam, cost) for all input (r,b)"""
+
+    fold, r_g, b_p, ncam, cost = params
+    rb_g = (r_g, ncam*b_p)
+    rb_list = candidates(r_g, b_p)
+
+    npz = RES.get('mcapprox', rg=r_g, bp=b_p, ncam=ncam, fold=fold,
+                  cost=cost)
+    if npz is None:
+        dset = shared.get(RES, 'fm', fold=fold, cost=cost)
+        tdata = (dset['metric_tr'], dset['reward_tr'])
+        policies = loadpolicies(fold, rb_list, cost)
+
+        approx = np.float64([sim.mcapprox(_rb, rb_g, ncam, _p, tdata)[0]
+                             for _rb, _p in zip(rb_list, policies)])
+        gains, _ = sim.mcsimulate_many(rb_list, policies, rb_g, ncam, tdata)
+
+        npz = {'rb_list': np.float64(rb_list), 'approx': approx,
+               'sim': gains}
+        RES.put('mcapprox', npz, rg=r_g, bp=b_p, ncam=ncam, fold=fold,
+                cost=cost)
+    approx, gains = npz['approx'], npz['sim']
+
+    # Rank of the approximate best among simulated, and loss from using it.
+    rank = np.sum(gains > gains[np.argmax(approx)])
+    return (params, np.mean(np.abs(approx-gains)),
+            np.max(np.abs(approx-gains)), rank,
+            np.max(gains) - gains[np.argmax(approx)])
+
+
+if __name__ == "__main__":
+    kernels.precompile()
+    with shared.Shared(RES, 'fm', [{'fold': 0, 'cost': 1}]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
+        ROWS = p.map(runtest, PLIST, chunksize=1)
+
+    print("r_g    b_p  ncam  mean|err|  max|err|  rank  loss")
+    for _p, _mae, _mxe, _rk, _ls in ROWS:
+        print("%.3f  %.1f  %d     %.5f    %.5f   %3d   %.5f"
+              % (_p[1], _p[2], _p[3], _mae, _mxe, _rk, _ls))
+    if prof.PATH:
+        prof.report()
@@ -3,36 +3,46 @@
 """Get and save policies many (r,b) combinations to test with multiple cams."""
 
 from multiprocessing import Pool
-import numpy as np
 from eomdp import policy as po
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
 
-FMPATH = 'save/fm_fold%d_cost%d.npz'
-OPATH = 'save/mcp_ri%03d_bi%04d_f%d_c%d.npy'
-PLIST = [(f, r/40, b/4, c)
+RES = store.Store('save/results.db')
+PLIST = [(f, [r/40 for r in range(2, 21)], b/4, c)
          for b in range(4, 41)
-         for r in range(2, 21)
          for f in range(3)
-         for c in [1]] + [(f, r, b, c)
-                          for r in [0.05, 0.1, 0.25]
+         for c in [1]] + [(f, [0.05, 0.1, 0.25], b, c)
                           for b in range(12, 17, 2)
                           for f in range(3)
                           for c in [1]]
 
 
+@prof.timed('runtest_mcpolicies', args=True)
 def runtest(params_frbc):
-    """Run test with (fold, rate, bdepth, cost)"""
+    """Run test with (fold, list of rates, bdepth, cost)"""
 
-    fold, rate, bdepth, cost = params_frbc
+    fold, rates, bdepth, cost = params_frbc
+    rates = [_r for _r in rates if not RES.has('mcp', rate=_r, bdepth=bdepth,
+                                               fold=fold, cost=cost)]
+    if not rates:
+        return
 
-    dset = np.load(FMPATH % (fold, cost))
-    metr_tr = dset['metric_tr']
-    rew_tr = dset['wcost_tr']-dset['scost_tr']
-    policy = po.mdp(rate, bdepth, (metr_tr, rew_tr))
+    dset = shared.get(RES, 'fm', fold=fold, cost=cost)
+    policies = po.mdp_batch(rates, [bdepth]*len(rates),
+                            (dset['metric_tr'], dset['reward_tr']))
 
-    np.save(OPATH % (int(rate*1000), int(bdepth*100), fold, cost), policy)
-    print("Completed frbc=%d, %f, %f, %d" % (fold, rate, bdepth, cost))
+    RES.putmany('mcp', [({'rate': rate, 'bdepth': bdepth,
+                          'fold': fold, 'cost': cost},
+                         {'policy': policies[(rate, bdepth)]})
+                        for rate in rates])
+    print("Completed frbc=%d, %s, %f, %d" % (fold, rates, bdepth, cost))
 
 
 if __name__ == "__main__":
-    with Pool() as p:
+    with shared.Shared(RES, 'fm', [{'fold': f, 'cost': c} for f in range(3)
+                                   for c in [1]]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
         p.map(runtest, PLIST, chunksize=1)
+    if prof.PATH:
+        prof.report()
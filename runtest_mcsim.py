@@ -3,46 +3,75 @@
 """Run all policies against all multi-device settings on train set."""
 
 from multiprocessing import Pool
-import numpy as np
+from eomdp import kernels
 from eomdp import simulate as sim
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
 
-FMPATH = 'save/fm_fold%d_cost%d.npz'
-PPATH = 'save/mcp_ri%03d_bi%04d_f%d_c%d.npy'
-OPATH = 'save/mcs_rg%03d_bp_%04d_nc%d_ri%03d_bi%04d_f%d_c%d.npz'
-PLIST = [(f, rg, bp, ncam, r/40, b/4, c)
+RES = store.Store('save/results.db')
+PLIST = [(f, rg, bp, ncam, c)
          for ncam in range(2, 9)
          for rg in [0.05, 0.1, 0.25]
          for bp in [1, 2]
-         for b in range(4, 41)
-         for r in range(2, 21)
          for f in range(3)
          for c in [1]]
+BIS = [b/4 for b in range(4, 41)]  # Search range for per-device depth
+RIS = [r/40 for r in range(2, 21)]  # Search range for per-device rate
+RBLIST = [(r, b) for b in BIS for r in RIS]
 
 
+def candidates(r_g, b_p):
+    """
+    Per-device (r_i, b_i) in RBLIST searched for global (r_g, b_p), i.e.,
+    those not smaller than (r_g, b_p) in both.
+    """
+    return [(r_i, b_i) for r_i, b_i in RBLIST
+            if not (r_i <= r_g and b_i < b_p)
+            and not (r_i < r_g and b_i <= b_p)]
+
+
+def loadpolicies(fold, rb_list, cost):
+    """Loads list of pre-computed policies for (r,b) in rb_list."""
+    keys, vals = RES.select('mcp', fold=fold, cost=cost)
+    pdict = {(store.keyval(_r), store.keyval(_b)): _v['policy']
+             for _r, _b, _v in zip(keys['rate'], keys['bdepth'], vals)}
+    return [pdict[(store.keyval(_r), store.keyval(_b))] for _r, _b in rb_list]
+
+
+@prof.timed('runtest_mcsim', args=True)
 def runtest(params):
-    """Run test with (fold, input/output (r,b), cost)"""
+    """Run test with (fold, output (r,b), ncam, cost) for all input (r,b)"""
 
-    fold, r_g, b_p, ncam, r_i, b_i, cost = params
+    fold, r_g, b_p, ncam, cost = params
     b_g = ncam*b_p
-    if r_i <= r_g and b_i < b_p:
-        return
-    if r_i < r_g and b_i <= b_p:
+    rb_list = [(r_i, b_i) for r_i, b_i in candidates(r_g, b_p)
+               if not RES.has('mcs', rg=r_g, bp=b_p, ncam=ncam, ri=r_i,
+                              bi=b_i, fold=fold, cost=cost)]
+    if not rb_list:
         return
 
-    dset = np.load(FMPATH % (fold, cost))
-    tdata = (dset['metric_tr'], dset['wcost_tr']-dset['scost_tr'])
-    policy = np.load(PPATH % (int(r_i*1000), int(b_i*100), fold, cost))
+    dset = shared.get(RES, 'fm', fold=fold, cost=cost)
+    tdata = (dset['metric_tr'], dset['reward_tr'])
+    policies = loadpolicies(fold, rb_list, cost)
 
-    gain, occups = sim.mcsimulate((r_i, b_i), (r_g, b_g), ncam, policy, tdata)
+    gains, occups = sim.mcsimulate_many(rb_list, policies, (r_g, b_g), ncam,
+                                        tdata)
 
-    npz = {'gain': gain, 'occups': occups}
-    np.savez_compressed(OPATH % (int(r_g*1000), int(b_p*100), ncam,
-                                 int(r_i*1000), int(b_i*100),
-                                 fold, cost), **npz)
-    print("Completed %d, %f, %f, %d, %f, %f, %d" % params)
+    RES.putmany('mcs', [({'rg': r_g, 'bp': b_p, 'ncam': ncam, 'ri': r_i,
+                          'bi': b_i, 'fold': fold, 'cost': cost},
+                         {'gain': gain, 'occups': occup})
+                        for (r_i, b_i), gain, occup
+                        in zip(rb_list, gains, occups)])
+    print("Completed %d, %f, %f, %d, %d" % params)
     return
 
 
 if __name__ == "__main__":
-    with Pool() as p:
+    kernels.precompile()
+    with shared.Shared(RES, 'fm', [{'fold': f, 'cost': c} for f in range(3)
+                                   for c in [1]]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
         p.map(runtest, PLIST, chunksize=1)
+    if prof.PATH:
+        prof.report()
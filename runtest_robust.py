@@ -4,10 +4,15 @@
 
 from multiprocessing import Pool
 import numpy as np
+from eomdp import kernels
 from eomdp import simulate as sim
 from eomdp import policy as po
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
 
-FMPATH = 'save/fm_fold%d_cost%d.npz'
+RES = store.Store('save/results.db')
+SIMMETHOD = 'exact'  # Or 'mc' for Monte Carlo simulation
 OPATH = 'save/1cam_r%03d_bdepth%02d_cost%d_dev%d.npz'
 PLIST = [(r, b/2, c, dev)
          for b in range(2, 11)
@@ -16,19 +21,20 @@ PLIST = [(r, b/2, c, dev)
          for dev in [-50, -25, -10, 10, 25, 50]]
 
 
+@prof.timed('runtest_robust', args=True)
 def runtest(params_rbcd):
     """Run test with (rate, bdepth, cost, deviation)"""
 
     rate, bdepth, cost, dev = params_rbcd
+    if RES.has('1cam_dev', rate=rate, bdepth=bdepth, cost=cost, dev=dev):
+        return
 
     npz = {'dev': dev, 'mdpcost': 0., 'naivecost': 0.}
     for fold in range(3):
-        dset = np.load(FMPATH % (fold, cost))
+        dset = shared.get(RES, 'fm', fold=fold, cost=cost)
 
-        metr_tr = dset['metric_tr']
-        rew_tr = dset['wcost_tr']-dset['scost_tr']
-        metr_ts = dset['metric_ts']
-        rew_ts = dset['wcost_ts']-dset['scost_ts']
+        metr_tr, rew_tr = dset['metric_tr'], dset['reward_tr']
+        metr_ts, rew_ts = dset['metric_ts'], dset['reward_ts']
 
         idx = np.argsort(metr_tr)
         didx = int(dev/100*len(idx))
@@ -36,12 +42,14 @@ def runtest(params_rbcd):
         metr_d, rew_d = metr_tr[idx], rew_tr[idx]
 
         policy = po.mdp(rate, bdepth, (metr_d, rew_d))
-        mdprew, stats = sim.simulate(rate, bdepth, policy, (metr_ts, rew_ts))
+        mdprew, stats = sim.simulate(rate, bdepth, policy, (metr_ts, rew_ts),
+                                     method=SIMMETHOD)
 
         nvpolicy = np.percentile(metr_d, (1.0-rate)*100.0) * \
             np.ones_like(policy)
 
-        nvprew, _ = sim.simulate(rate, bdepth, nvpolicy, (metr_ts, rew_ts))
+        nvprew, _ = sim.simulate(rate, bdepth, nvpolicy, (metr_ts, rew_ts),
+                                 method=SIMMETHOD)
 
         mwcost = np.mean(dset['wcost_ts'])
         npz['mdpcost'] = npz['mdpcost'] + (mwcost - mdprew)/3.0
@@ -53,11 +61,18 @@ def runtest(params_rbcd):
             npz['occup_s'] = stats[2]
             npz['policy'] = np.mean(policy >= metr_tr[:, np.newaxis], 0)
 
+    RES.put('1cam_dev', npz, rate=rate, bdepth=bdepth, cost=cost, dev=dev)
     np.savez_compressed(OPATH % (int(rate*1000), int(bdepth*10),
                                  cost, dev), **npz)
     print("Completed r=%f, b=%f, cost=%d, dev=%d" % (rate, bdepth, cost, dev))
 
 
 if __name__ == "__main__":
-    with Pool() as p:
+    if SIMMETHOD == 'mc':
+        kernels.precompile()
+    with shared.Shared(RES, 'fm', [{'fold': f, 'cost': c} for f in range(3)
+                                   for c in [1]]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
         p.map(runtest, PLIST, chunksize=1)
+    if prof.PATH:
+        prof.report()
@@ -4,10 +4,15 @@
 
 from multiprocessing import Pool
 import numpy as np
+from eomdp import kernels
 from eomdp import simulate as sim
 from eomdp import policy as po
+from eomdp import prof
+from eomdp import shared
+from eomdp import store
 
-FMPATH = 'save/fm_fold%d_cost%d.npz'
+RES = store.Store('save/results.db')
+SIMMETHOD = 'exact'  # Or 'mc' for Monte Carlo simulation
 OPATH = 'save/1cam_r%03d_bdepth%02d_cost%d.npz'
 PLIST = [(r/20, b/2, c)
          for b in range(2, 11)
@@ -15,20 +20,21 @@ PLIST = [(r/20, b/2, c)
          for c in range(3)]
 
 
+@prof.timed('runtest_single', args=True)
 def runtest(params_rbc):
     """Run test with (rate, bdepth, cost)"""
 
     rate, bdepth, cost = params_rbc
+    if RES.has('1cam', rate=rate, bdepth=bdepth, cost=cost):
+        return
 
     npz = {'lb': 0., 'wcost': 0., 'scost': 0.,
            'naivecost': 0., 'mdpcost': 0.}
     for fold in range(3):
-        dset = np.load(FMPATH % (fold, cost))
+        dset = shared.get(RES, 'fm', fold=fold, cost=cost)
 
-        metr_tr = dset['metric_tr']
-        rew_tr = dset['wcost_tr']-dset['scost_tr']
-        metr_ts = dset['metric_ts']
-        rew_ts = dset['wcost_ts']-dset['scost_ts']
+        metr_tr, rew_tr = dset['metric_tr'], dset['reward_tr']
+        metr_ts, rew_ts = dset['metric_ts'], dset['reward_ts']
 
         policy = po.mdp(rate, bdepth, (metr_tr, rew_tr))
 
@@ -36,8 +42,10 @@ def runtest(params_rbc):
         lbrew = np.mean(rew_ts * (metr_ts >= nvpolicy))
         nvpolicy = nvpolicy * np.ones_like(policy)
 
-        mdprew, stats = sim.simulate(rate, bdepth, policy, (metr_ts, rew_ts))
-        nvprew, nst = sim.simulate(rate, bdepth, nvpolicy, (metr_ts, rew_ts))
+        mdprew, stats = sim.simulate(rate, bdepth, policy, (metr_ts, rew_ts),
+                                     method=SIMMETHOD)
+        nvprew, nst = sim.simulate(rate, bdepth, nvpolicy, (metr_ts, rew_ts),
+                                   method=SIMMETHOD)
 
         mwcost = np.mean(dset['wcost_ts'])
         npz['wcost'] = npz['wcost'] + mwcost/3.0
@@ -54,10 +62,17 @@ def runtest(params_rbc):
             npz['nsrate'] = np.sum(nst[1])
             npz['naive_m'] = nst[0][:, 0] / nst[0][:, 1]
 
+    RES.put('1cam', npz, rate=rate, bdepth=bdepth, cost=cost)
     np.savez_compressed(OPATH % (int(rate*1000), int(bdepth*10), cost), **npz)
     print("Completed r=%f, b=%f, cost=%d" % (rate, bdepth, cost))
 
 
 if __name__ == "__main__":
-    with Pool() as p:
+    if SIMMETHOD == 'mc':
+        kernels.precompile()
+    with shared.Shared(RES, 'fm', [{'fold': f, 'cost': c} for f in range(3)
+                                   for c in range(3)]) as shm, \
+            Pool(initializer=shared.attach, initargs=(shm.spec,)) as p:
         p.map(runtest, PLIST, chunksize=1)
+    if prof.PATH:
+        prof.report()